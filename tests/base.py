@@ -20,7 +20,9 @@
 import datetime
 import os
 import re
+import socket
 import sys
+import time
 import unittest
 
 import todo
@@ -49,6 +51,22 @@ class BaseTest(unittest.TestCase):
             os.unlink(todotxt)
         if os.path.isfile(donetxt):
             os.unlink(donetxt)
+        if os.path.isfile(todotxt + ".lock"):
+            os.unlink(todotxt + ".lock")
+
+
+    def wait_listening(self, path):
+        """Wait for a server to accept connections on the unix socket path,
+        which exists from before it listens."""
+        for i in range(100):
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                conn.connect(path)
+                return
+            except socket.error:
+                time.sleep(0.05)
+            finally:
+                conn.close()
 
 
     def count_matches(self, regexp=None):
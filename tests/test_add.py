@@ -31,10 +31,41 @@ class TestAdd(base.BaseTest):
         self.add_todo_predate(self.num)
         self.assertNumLines(self.num, "\d{4}-\d{2}-\d{2}.*Test \d+")
 
+    def test_add_predate_done(self):
+        todo.CONFIG["PRE_DATE"] = True
+        todo.add_todo("x 2012-01-01 (A) done thing")
+        self.assertNumLines(1, "\d{4}-\d{2}-\d{2} x 2012-01-01 \(A\) done")
+
     def test_add_nofile(self):
         os.unlink(todo.CONFIG["TODO_FILE"])
         self.test_add()
 
+    def test_add_line_numbers(self):
+        for i in range(1, self.num + 1):
+            self.assertEqual(todo.add_todo("Test {0}".format(i)), i)
+            self.assertEqual(todo.count_todos(), i)
+        with open(todo.CONFIG["TODO_FILE"], "a") as fd:
+            fd.write("No newline")
+        self.assertEqual(todo.count_todos(), self.num + 1)
+
+    def test_add_after_no_newline(self):
+        todo.CONFIG["CACHE_FILE"] = "test_todo.cache"
+        try:
+            with open(todo.CONFIG["TODO_FILE"], "w") as fd:
+                fd.write("Test 1\nNo newline")
+            # which also builds the cache
+            self.assertEqual(len(list(todo.iter_tasks())), 2)
+            self.assertEqual(todo.add_todo("Test 3"), 3)
+            self.assertEqual(list(todo.iter_todos()),
+                    ["Test 1\n", "No newline\n", "Test 3\n"])
+            self.assertEqual([t.text for t in todo.iter_tasks()],
+                    ["Test 1", "No newline", "Test 3"])
+            self.assertEqual(todo.count_todos(), 3)
+        finally:
+            todo.CONFIG["CACHE_FILE"] = ""
+            if os.path.isfile("test_todo.cache"):
+                os.unlink("test_todo.cache")
+
     def add_todo(self, n):
         lines = self._test_lines_no_pri(n)
         for line in lines:
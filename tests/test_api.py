@@ -0,0 +1,166 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import fcntl
+import json
+import os
+import signal
+import socket
+import unittest
+
+import base
+import todo
+
+class ApiTest(base.BaseTest):
+    sock = os.path.abspath("test_api.sock")
+
+    def tearDown(self):
+        if os.path.exists(self.sock):
+            os.unlink(self.sock)
+        super(ApiTest, self).tearDown()
+
+    def test_http_request(self):
+        data = b"GET /todos HTTP/1.1\r\nHost: x\r\n\r\nPOST"
+        self.assertEqual(todo._http_request(data),
+                ("GET", "/todos", True, b"", b"POST"))
+        data = b"POST /todos HTTP/1.0\r\nContent-Length: 4\r\n\r\n{}"
+        self.assertEqual(todo._http_request(data), None)
+        self.assertEqual(todo._http_request(data + b"{}"),
+                ("POST", "/todos", False, b"{}{}", b""))
+        self.assertRaises(ValueError, todo._http_request, b"GET /\r\n\r\n")
+
+    def test_request(self):
+        todo.addm_todo("\n".join(self._test_lines_project(9)))
+        code, job = todo._api_request("GET", "/todos?q=%2Bfoo", b"")
+        self.assertEqual((code, job[0]), (None, "read"))
+        code, reply = todo._api_read(*job[1:])
+        self.assertEqual(code, 200)
+        self.assertEqual(reply["total"], 9)
+        self.assertEqual([t["num"] for t in reply["todos"]], [1])
+        self.assertEqual(reply["todos"][0]["projects"], ["foo"])
+        self.assertEqual(todo._api_request("GET", "/todos?q=due%3Csomeday",
+            b"")[0], 400)
+        code, job = todo._api_request("GET", "/todos?q=pri:Z&q=%2Bfoo", b"")
+        self.assertEqual(todo._api_read(*job[1:])[1]["todos"], [])
+        self.assertEqual(todo._api_request("GET", "/todo", b"")[0], 404)
+        self.assertEqual(todo._api_request("DELETE", "/todos", b"")[0], 405)
+        self.assertEqual(todo._api_request("POST", "/todos/x/do", b"")[0],
+                400)
+        self.assertEqual(todo._api_request("POST", "/todos/1/pri",
+            b'{"pri": "Z"}')[0], 400)
+        self.assertEqual(todo._api_request("POST", "/todos",
+            b'{"text": "a\\nb"}')[0], 400)
+        self.assertEqual(todo._api_request("POST", "/todos/1-3,+foo/do", b""),
+                (None, ("change", todo.do_todo, ["1-3", "+foo"], [])))
+        self.assertEqual(todo._api_request("POST", "/todos/2/pri",
+            b'{"pri": null}'),
+            (None, ("change", todo.de_prioritize_todo, ["2"], [])))
+
+    def test_change(self):
+        todo.add_todo("Test 1")
+        code, reply = todo._api_change(todo.do_todo, ["99"], [])
+        self.assertEqual(code, 404)
+        self.assertNumLines(1)
+        code, reply = todo._api_change(todo.prioritize_todo, ["1"], ["A"])
+        self.assertEqual(code, 200)
+        self.assertNumLines(1, "\\(A\\) Test 1")
+        code, reply = todo._api_change(todo.add_todo, None, "Test 2")
+        self.assertEqual((code, reply["num"]), (201, 2))
+
+    def test_loopback(self):
+        self.assertTrue(todo._loopback("localhost"))
+        self.assertTrue(todo._loopback("127.0.0.1"))
+        self.assertFalse(todo._loopback("0.0.0.0"))
+        self.assertRaises(SystemExit, todo.api, ["0.0.0.0:18089"])
+
+    @unittest.skipIf(todo.asyncio is None, "needs asyncio")
+    def test_api(self):
+        todo.add_todo("Test 1")
+        pid = os.fork()
+        if pid == 0:
+            try:
+                todo.api([self.sock])
+            finally:
+                os._exit(0)
+        self.wait_listening(self.sock)
+        try:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.connect(self.sock)
+            # Pipelined on one connection, and answered in order.
+            body = b'{"text": "Test 2"}'
+            conn.sendall(b"".join([
+                b"POST /todos HTTP/1.1\r\nContent-Length: ",
+                str(len(body)).encode("ascii"), b"\r\n\r\n", body,
+                b'POST /todos/1/pri HTTP/1.1\r\nContent-Length: 12\r\n\r\n',
+                b'{"pri": "A"}',
+                b"GET /todos HTTP/1.1\r\nConnection: close\r\n\r\n"]))
+            data = b""
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            conn.close()
+        finally:
+            os.kill(pid, signal.SIGINT)
+            os.waitpid(pid, 0)
+
+        replies = data.split(b"HTTP/1.1 ")[1:]
+        self.assertEqual([r[:3] for r in replies], [b"201", b"200", b"200"])
+        added = json.loads(replies[0].split(b"\r\n\r\n")[1].decode("utf-8"))
+        self.assertEqual(added["num"], 2)
+        listed = json.loads(replies[2].split(b"\r\n\r\n")[1].decode("utf-8"))
+        self.assertEqual([t["text"] for t in listed["todos"]],
+                ["(A) Test 1", "Test 2"])
+        self.assertFalse(os.path.exists(self.sock))
+
+    @unittest.skipIf(todo.asyncio is None, "needs asyncio")
+    def test_locked(self):
+        todo.add_todo("Test 1")
+        holder = open(todo._lock_path(), "a")
+        fcntl.flock(holder, fcntl.LOCK_EX)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                todo.api([self.sock])
+            finally:
+                os._exit(0)
+        self.wait_listening(self.sock)
+        try:
+            waiting = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            waiting.connect(self.sock)
+            waiting.sendall(b"GET /todos HTTP/1.0\r\n\r\n")
+            # Others are still answered while that read waits for the lock.
+            other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            other.connect(self.sock)
+            other.settimeout(5)
+            other.sendall(b"GET /nothing HTTP/1.0\r\n\r\n")
+            self.assertTrue(other.recv(4096).startswith(b"HTTP/1.1 404"))
+            other.close()
+            fcntl.flock(holder, fcntl.LOCK_UN)
+            waiting.settimeout(5)
+            self.assertTrue(waiting.recv(4096).startswith(b"HTTP/1.1 200"))
+            waiting.close()
+        finally:
+            holder.close()
+            os.kill(pid, signal.SIGINT)
+            os.waitpid(pid, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
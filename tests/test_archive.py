@@ -0,0 +1,83 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import os
+import shutil
+import unittest
+
+import base
+import todo
+
+donedir = "test_done"
+
+class ArchiveTest(base.BaseTest):
+
+    def setUp(self):
+        super(ArchiveTest, self).setUp()
+        todo.CONFIG["DONE_DIR"] = donedir
+        with open(todo.CONFIG["DONE_FILE"], "w") as fd:
+            for month in range(1, 13):
+                fd.write("x 2011-{0:02d}-15 Test {0}\n".format(month))
+
+    def tearDown(self):
+        todo.CONFIG["DONE_DIR"] = ""
+        todo.CONFIG["DATE_FROM"] = todo.CONFIG["DATE_TO"] = ""
+        shutil.rmtree(donedir, True)
+        super(ArchiveTest, self).tearDown()
+
+    def test_split_flat(self):
+        todo.archive(["split"])
+        self.assertEqual(os.path.getsize(todo.CONFIG["DONE_FILE"]), 0)
+        self.assertEqual(len(todo._read_manifest()), 12)
+        self.assertEqual(len(list(todo.iter_done())), 12)
+        self.assertEqual(len(list(todo.iter_done("2011-03", "2011-05-14"))),
+                2)
+
+        todo.archive(["flat"])
+        with open(todo.CONFIG["DONE_FILE"]) as fd:
+            self.assertEqual(len(fd.readlines()), 12)
+        self.assertFalse(os.path.exists(donedir))
+
+    def test_round_trip(self):
+        with open(todo.CONFIG["DONE_FILE"]) as fd:
+            expected = fd.readlines()
+        todo.archive(["split"])
+        todo.archive(["flat"])
+        todo.archive(["split"])
+        self.assertEqual(list(todo.iter_done()), expected)
+        self.assertEqual(todo.count_done(), 12)
+        todo.archive(["flat"])
+        with open(todo.CONFIG["DONE_FILE"]) as fd:
+            self.assertEqual(fd.readlines(), expected)
+
+    def test_do(self):
+        todo.archive(["split"])
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        todo.do_todo(["1-10"])
+        self.assertEqual(len(todo._read_manifest()), 13)
+        self.assertEqual(len(list(todo.iter_done())), 22)
+        os.unlink(os.path.join(donedir, "manifest"))
+        self.assertEqual(len(todo._read_manifest()), 13)
+
+    def test_list_all_range(self):
+        todo.archive(["split"])
+        todo.CONFIG["DATE_FROM"] = "2011-06"
+        self.assertEqual(len(list(todo.iter_todos(True))), 7)
+
+if __name__ == "__main__":
+    unittest.main()
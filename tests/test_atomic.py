@@ -0,0 +1,97 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import errno
+import os
+import unittest
+
+import base
+import todo
+
+tmptxt = "test_todo.tmp"
+
+class AtomicTest(base.BaseTest):
+
+    def setUp(self):
+        super(AtomicTest, self).setUp()
+        todo.CONFIG["TMP_FILE"] = tmptxt
+
+    def tearDown(self):
+        todo.CONFIG["TMP_FILE"] = ""
+        if os.path.isfile(tmptxt):
+            os.unlink(tmptxt)
+        super(AtomicTest, self).tearDown()
+
+    def test_replaced(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        inode = os.stat(todo.CONFIG["TODO_FILE"]).st_ino
+        todo.prioritize_todo(["2", "B"])
+        self.assertNotEqual(os.stat(todo.CONFIG["TODO_FILE"]).st_ino, inode)
+        self.assertFalse(os.path.exists(tmptxt))
+        self.assertNumLines(self.num)
+        self.assertNumLines(1, "\(B\) Test 1$")
+
+    def test_do(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        for i in range(self.num, 0, -1):
+            todo.do_todo(str(i))
+        self.assertNumLines(0)
+        with open(todo.CONFIG["DONE_FILE"]) as fd:
+            self.assertEqual(len(fd.readlines()), self.num)
+
+    def test_batch(self):
+        with todo.sync_batch():
+            todo.add_todo("Test 1")
+            todo.delete_todo("1")
+            self.assertNumLines(0)
+            self.assertTrue(todo._sync_pending)
+        self.assertEqual(todo._sync_pending, None)
+
+    def test_synced_before_replace(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(3)))
+        events = []
+        fsync, replace = os.fsync, todo._replace
+        todo.os.fsync = lambda fd: events.append("fsync") or fsync(fd)
+        todo._replace = lambda a, b: events.append("replace") or replace(a, b)
+        try:
+            with todo.sync_batch():
+                todo.delete_todo("1")
+        finally:
+            todo.os.fsync, todo._replace = fsync, replace
+        self.assertEqual(events[:2], ["fsync", "replace"])
+        self.assertNumLines(2)
+
+    def test_cross_device(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(3)))
+        replace = todo._replace
+
+        def exdev(src, dst):
+            if src == tmptxt:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            replace(src, dst)
+        todo._replace = exdev
+        try:
+            todo.prioritize_todo(["2", "B"])
+        finally:
+            todo._replace = replace
+        self.assertNumLines(3)
+        self.assertNumLines(1, "\(B\) Test 1$")
+        self.assertFalse(os.path.exists(tmptxt))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import os
+import unittest
+
+import base
+import todo
+
+cachetxt = "test_todo.cache"
+
+class CacheTest(base.BaseTest):
+
+    def setUp(self):
+        super(CacheTest, self).setUp()
+        todo.CONFIG["CACHE_FILE"] = cachetxt
+
+    def tearDown(self):
+        todo.CONFIG["CACHE_FILE"] = ""
+        if os.path.isfile(cachetxt):
+            os.unlink(cachetxt)
+        super(CacheTest, self).tearDown()
+
+    def assert_cached(self):
+        records = todo._load_cache()
+        self.assertNotEqual(records, None)
+        expected = [todo.Task(i + 1, line).record()
+                for (i, line) in enumerate(todo.iter_todos())]
+        self.assertEqual(records, expected)
+
+    def test_cache(self):
+        todo.addm_todo("\n".join(self._test_lines_date(self.num)))
+        self.assertEqual(todo._load_cache(), None)
+        plain = todo.format_lines()
+        self.assert_cached()
+        self.assertEqual(todo.format_lines(), plain)
+
+    def test_refresh(self):
+        todo.addm_todo("\n".join(self._test_lines_project(self.num)))
+        list(todo.iter_tasks())
+        todo.prioritize_todo(["4", "C"])
+        todo.do_todo(["+foo"])
+        todo.add_todo("Test +new @context #{2012-01-01}")
+        self.assert_cached()
+
+    def test_external_edit(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        list(todo.iter_tasks())
+        with open(todo.CONFIG["TODO_FILE"], "a") as fd:
+            fd.write("Added by hand\n")
+        self.assertEqual(todo._load_cache(), None)
+        self.assertEqual(list(todo.iter_tasks())[-1].text, "Added by hand")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import datetime
+import os
+import sys
+import unittest
+
+import base
+import todo
+
+datestxt = "test_todo.dates"
+
+class DateIndexTest(base.BaseTest):
+
+    def setUp(self):
+        super(DateIndexTest, self).setUp()
+        todo.CONFIG["DATE_INDEX"] = datestxt
+
+    def tearDown(self):
+        todo.CONFIG["DATE_INDEX"] = ""
+        if os.path.isfile(datestxt):
+            os.unlink(datestxt)
+        super(DateIndexTest, self).tearDown()
+
+    def assert_indexed(self):
+        dates = todo.date_index()
+        os.unlink(datestxt)
+        self.assertEqual(dates, todo.date_index())
+
+    def test_index(self):
+        todo.addm_todo("\n".join(self._test_lines_date(self.num)))
+        today = datetime.date.today()
+        week = today + datetime.timedelta(6)
+        index = todo.date_index()
+        self.assertEqual(todo.dated_lines(index, today, week),
+                set(range(1, 8)))
+        self.assertEqual(todo.dated_lines(index, until=today), set([1]))
+        self.assertEqual(len(todo.dated_lines(index)), self.num)
+
+    def test_refresh(self):
+        todo.addm_todo("\n".join(self._test_lines_date(self.num)))
+        todo.date_index()
+        todo.prioritize_todo(["4", "C"])
+        todo.add_todo("Test #{2012-01-01} #{2012-1-1}")
+        self.assert_indexed()
+        todo.do_todo(["2"])
+        todo.delete_todo(["1"])
+        self.assert_indexed()
+
+    def test_window(self):
+        todo.addm_todo("\n".join(["Old #{2012-01-01}", "Both #{2012-01-02} "
+            "#{2012-02-01}", "Late #{2012-03-01}", "None"]))
+        window = (datetime.date(2012, 1, 2), datetime.date(2012, 2, 28))
+        lines, sorted = todo._list_("date", window=window)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(sorted[0], "2012-01-02:\n")
+        self.assertEqual(sorted[2], "2012-02-01:\n")
+        self.assertEqual(len(sorted), 4)
+
+    def test_overdue(self):
+        todo.addm_todo("\n".join(["Late #{2012-01-01}",
+            "x 2012-01-02 Done #{2012-01-01}", "Later #{2999-01-01}"]))
+        todo.CONFIG["OVERDUE"] = True
+        sys.stdout = todo.StringIO()
+        try:
+            todo.list_date()
+            shown = sys.stdout.getvalue()
+        finally:
+            todo.CONFIG["OVERDUE"] = False
+        self.assertTrue("Late" in shown)
+        self.assertFalse("Done" in shown)
+        self.assertFalse("Later" in shown)
+
+if __name__ == "__main__":
+    unittest.main()
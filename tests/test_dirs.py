@@ -0,0 +1,91 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import os
+import shutil
+import sys
+import unittest
+
+import base
+import todo
+
+class DirsTest(base.BaseTest):
+    root = "test_dirs"
+
+    def setUp(self):
+        super(DirsTest, self).setUp()
+        self.saved = dict(todo.CONFIG)
+        todo.CONFIG["PLAIN"] = True
+        todo.CONFIG["NO_PRI"] = False
+        todo.CONFIG["TODOTXT_FORMAT"] = ""
+        lines = {"a": ["Test a1 +foo", "(B) Test a2", "(A) Test a3 +foo"],
+                "b": ["(A) Test b1 +foo", "Test b2", "(C) Test b3 +foo"]}
+        for (name, items) in lines.items():
+            os.makedirs(os.path.join(self.root, name))
+            with open(os.path.join(self.root, name, "todo.txt"), "w") as fd:
+                fd.write("".join([l + "\n" for l in items]))
+
+    def tearDown(self):
+        todo.CONFIG.clear()
+        todo.CONFIG.update(self.saved)
+        shutil.rmtree(self.root)
+        super(DirsTest, self).tearDown()
+
+    def listing(self, args):
+        out = os.path.join(self.root, "out")
+        stdout = sys.stdout
+        sys.stdout = open(out, "w")
+        try:
+            todo.list_todo(args)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        with open(out) as fd:
+            return fd.read().splitlines()
+
+    def test_dirs(self):
+        a = os.path.join(self.root, "a")
+        b = os.path.join(self.root, "b")
+        self.assertEqual(todo._todo_dirs(" {0}/*,{1}".format(self.root, a)),
+                [a, b])
+        todo.CONFIG["TODO_DIRS"] = os.path.join(self.root, "*")
+        self.assertEqual(self.listing(["+foo"]),
+                [a + ":3 (A) Test a3 +foo", b + ":1 (A) Test b1 +foo",
+                    b + ":3 (C) Test b3 +foo", a + ":1 Test a1 +foo",
+                    "--", "TODO: 4 of 6 tasks shown"])
+        os.makedirs(os.path.join(self.root, "empty"))
+        empty = os.path.join(self.root, "empty")
+        missing = os.path.join(self.root, "missing")
+        todo.CONFIG["TODO_DIRS"] = ",".join([a, empty, missing])
+        lines = self.listing(["+foo"])
+        self.assertEqual(lines[:2], [a + ":3 (A) Test a3 +foo",
+            a + ":1 Test a1 +foo"])
+        self.assertEqual(lines[2:4], ["TODO: Skipped {0}: no todo.txt".format(
+            d) for d in (empty, missing)])
+        self.assertEqual(os.listdir(empty), [])
+        self.assertFalse(os.path.exists(missing))
+
+        todo.CONFIG["TODO_DIRS"] = ",".join([a, b])
+        todo.CONFIG["LIMIT"] = 2
+        todo.CONFIG["OFFSET"] = 1
+        self.assertEqual(self.listing([])[:2],
+                [b + ":1 (A) Test b1 +foo", a + ":2 (B) Test a2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
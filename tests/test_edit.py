@@ -0,0 +1,53 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import unittest
+
+import base
+import todo
+
+class EditTest(base.BaseTest):
+
+    def setUp(self):
+        super(EditTest, self).setUp()
+        self.lines = [l + "\n" for l in self._test_lines_pri(self.num)]
+        todo.addm_todo("".join(self.lines)[:-1])
+
+    def assert_edited(self, edits):
+        todo.edit_lines(edits)
+        expected = []
+        for (i, line) in enumerate(self.lines):
+            new = edits.get(i + 1, line)
+            if new is not None:
+                expected.append(new)
+        self.assertEqual(list(todo.iter_todos()), expected)
+
+    def test_same_length(self):
+        self.assert_edited({7: "(Q) Test 6\n"})
+
+    def test_longer(self):
+        self.assert_edited({self.num: "(A) Test with more words\n"})
+
+    def test_remove(self):
+        self.assert_edited({1: None})
+
+    def test_many(self):
+        self.assert_edited({3: None, 10: "Test\n", 11: None})
+
+if __name__ == "__main__":
+    unittest.main()
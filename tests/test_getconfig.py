@@ -49,6 +49,23 @@ class TestConfig(base.BaseTest):
                     val = True
                 self.config_assert(key, val)
 
+    def test_numbers(self):
+        self.backup = todo.CONFIG.copy()
+        environ = os.environ.copy()
+        path = "test_numbers.config"
+        with open(path, "w") as fd:
+            fd.write("export JOURNAL_COMPACT=0\nexport LOCK_TIMEOUT=1\n"
+                    "export MAX_LINES=100\nexport USE_PAGER=1\n")
+        try:
+            todo.get_config(config_name=path)
+            self.config_assert("JOURNAL_COMPACT", 0)
+            self.config_assert("LOCK_TIMEOUT", 1)
+            self.config_assert("MAX_LINES", 100)
+            self.config_assert("USE_PAGER", True)
+        finally:
+            os.unlink(path)
+            os.environ = environ
+
     def test_configs(self):
         self.backup = todo.CONFIG.copy()
         self.environ = os.environ.copy()
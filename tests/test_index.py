@@ -0,0 +1,82 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import os
+import unittest
+
+import base
+import todo
+
+indextxt = "test_todo.idx"
+
+class IndexTest(base.BaseTest):
+
+    def setUp(self):
+        super(IndexTest, self).setUp()
+        todo.CONFIG["INDEX_FILE"] = indextxt
+
+    def tearDown(self):
+        todo.CONFIG["INDEX_FILE"] = ""
+        if os.path.isfile(indextxt):
+            os.unlink(indextxt)
+        super(IndexTest, self).tearDown()
+
+    def assert_lines(self):
+        lines = list(todo.iter_todos())
+        for (i, line) in enumerate(lines):
+            self.assertEqual(todo.read_line(i + 1), line)
+        self.assertEqual(todo.read_line(len(lines) + 1), None)
+        self.assertEqual(todo.count_todos(), len(lines))
+        self.assertEqual(todo.read_line(0), None)
+
+    def test_read_line(self):
+        todo.addm_todo("\n".join(self._test_lines_pri(self.num)))
+        self.assertEqual(todo._index_stamp(),
+                todo._file_stamp(todo.CONFIG["TODO_FILE"]))
+        self.assert_lines()
+
+    def test_mutations(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        todo.prioritize_todo(["3", "A"])
+        todo.append_todo(["7", "appended"])
+        todo.do_todo("1")
+        todo.delete_todo("10")
+        self.assert_lines()
+
+    def test_replaced(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        held = open(indextxt, "rb")
+        try:
+            before = held.read()
+            todo.append_todo(["7", "appended"])
+            held.seek(0)
+            # An open reader still sees the old index whole.
+            self.assertEqual(held.read(), before)
+        finally:
+            held.close()
+        self.assert_lines()
+
+    def test_external_edit(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        with open(todo.CONFIG["TODO_FILE"], "w") as fd:
+            fd.write("Edited by hand\nand made shorter\n")
+        self.assertEqual(todo.read_line(2), "and made shorter\n")
+        self.assertEqual(todo.read_line(3), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import glob
+import marshal
+import os
+import shutil
+import sys
+import unittest
+
+import base
+import todo
+
+journaltxt = "test_todo.journal"
+sidecars = {"INDEX_FILE": "test_todo.index", "CACHE_FILE": "test_todo.cache",
+        "TAG_INDEX": "test_todo.tags"}
+
+class JournalTest(base.BaseTest):
+
+    def setUp(self):
+        super(JournalTest, self).setUp()
+        todo.CONFIG["JOURNAL_COMPACT"] = 0
+        todo.CONFIG.update(sidecars)
+
+    def tearDown(self):
+        todo.CONFIG["JOURNAL_FILE"] = ""
+        todo.CONFIG["JOURNAL_COMPACT"] = 1048576
+        for (key, path) in list(sidecars.items()) + [("", journaltxt)]:
+            if key:
+                todo.CONFIG[key] = ""
+            if os.path.isfile(path):
+                os.unlink(path)
+        for path in self.set_aside():
+            os.unlink(path)
+        super(JournalTest, self).tearDown()
+
+    def set_aside(self):
+        return glob.glob(journaltxt + ".*")
+
+    def mutate(self):
+        todo.addm_todo("\n".join(self._test_lines_project(self.num)))
+        todo.prioritize_todo(["4", "C"])
+        todo.delete_todo(["2"])
+        todo.add_todo("Test +new @context")
+        todo.append_todo(["1", "more"])
+        todo.do_todo(["+foo"])
+        todo.de_prioritize_todo(["10-12"])
+        todo.add_todo("Last")
+        return (list(todo.iter_todos()), list(todo.iter_done()))
+
+    def test_replay(self):
+        expected = self.mutate()
+        open(todo.CONFIG["TODO_FILE"], "w").close()
+        open(todo.CONFIG["DONE_FILE"], "w").close()
+        todo.CONFIG["JOURNAL_FILE"] = journaltxt
+        self.assertEqual(self.mutate(), expected)
+        self.assertEqual(todo.count_todos(), len(expected[0]))
+        self.assertEqual(todo.read_line(3), expected[0][2])
+        new = [i + 1 for (i, l) in enumerate(expected[0]) if "+new" in l]
+        self.assertEqual(sorted(todo.select_todos(["+new"])), new)
+        self.assertEqual(self.count_matches(), len(expected[0]))
+        with open(todo.CONFIG["TODO_FILE"]) as fd:
+            self.assertEqual(len(fd.readlines()), self.num)
+        self.assertTrue(todo.compact_journal())
+        self.assertFalse(os.path.isfile(journaltxt))
+        with open(todo.CONFIG["TODO_FILE"]) as fd:
+            self.assertEqual(fd.readlines(), expected[0])
+        self.assertFalse(todo.compact_journal())
+
+    def test_stale(self):
+        todo.CONFIG["JOURNAL_FILE"] = journaltxt
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        todo.delete_todo(["1"])
+        shutil.copy(journaltxt, "test_todo.old")
+        todo.compact_journal()
+        shutil.move("test_todo.old", journaltxt)
+        self.assertEqual(list(todo.iter_todos())[0], "Test 1\n")
+        self.assertEqual(len(self.set_aside()), 1)
+        todo.delete_todo(["1"])
+        self.assertEqual(list(todo.iter_todos())[0], "Test 2\n")
+
+    def test_lookup(self):
+        todo.CONFIG["JOURNAL_FILE"] = journaltxt
+        expected = self.mutate()[0]
+        for key in ("INDEX_FILE", "CACHE_FILE", "TAG_INDEX"):
+            todo.CONFIG[key] = ""
+        # Neither is worked out by replaying the journal over todo.txt.
+        replay = todo._replay
+        todo._replay = None
+        try:
+            self.assertEqual(todo.count_todos(), len(expected))
+            self.assertEqual([todo.read_line(i + 1)
+                for i in range(len(expected) + 1)], expected + [None])
+        finally:
+            todo._replay = replay
+
+    def test_changed(self):
+        todo.CONFIG["JOURNAL_FILE"] = journaltxt
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        todo.delete_todo(["1"])
+        # Edited in place, so the inode stays the same.
+        with open(todo.CONFIG["TODO_FILE"], "a") as fd:
+            fd.write("Added by hand\n")
+        # The journal's edit no longer applies, but it's kept and reported.
+        sys.stdout = todo.StringIO()
+        todo.prioritize_todo(["2", "A"])
+        self.assertTrue("no longer apply" in sys.stdout.getvalue())
+        lines = list(todo.iter_todos())
+        self.assertEqual(lines[0], "Test 0\n")
+        self.assertEqual(lines[1], "(A) Test 1\n")
+        self.assertEqual(lines[-1], "Added by hand\n")
+        self.assertEqual(todo.count_todos(), self.num + 1)
+        aside = self.set_aside()
+        self.assertEqual(len(aside), 1)
+        with open(aside[0], "rb") as fd:
+            marshal.load(fd)
+            self.assertEqual(marshal.load(fd), {1: None})
+
+    def test_no_newline(self):
+        todo.CONFIG["JOURNAL_FILE"] = journaltxt
+        with open(todo.CONFIG["TODO_FILE"], "w") as fd:
+            fd.write("Test 1\nNo newline")
+        todo.prioritize_todo(["1", "A"])
+        todo.add_todo("Test 3")
+        todo.compact_journal()
+        with open(todo.CONFIG["TODO_FILE"]) as fd:
+            self.assertEqual(fd.readlines(),
+                    ["(A) Test 1\n", "No newline\n", "Test 3\n"])
+
+    def test_auto_compact(self):
+        todo.CONFIG["JOURNAL_FILE"] = journaltxt
+        todo.CONFIG["JOURNAL_COMPACT"] = 100
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        for i in range(10):
+            todo.append_todo(["1", "more"])
+        # The last append may have compacted the journal away.
+        self.assertTrue(not os.path.exists(journaltxt) or
+                os.path.getsize(journaltxt) <= 100)
+        self.assertEqual(todo.read_line(1).split().count("more"), 10)
+
+if __name__ == "__main__":
+    unittest.main()
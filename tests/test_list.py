@@ -18,12 +18,29 @@
 
 import os
 import re
+import sys
 import unittest
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 import todo
 import base
 
 class TestList(base.BaseTest):
+
+    def setUp(self):
+        super(TestList, self).setUp()
+        # The listings are compared without colors.
+        self.plain = todo.CONFIG["PLAIN"]
+        todo.CONFIG["PLAIN"] = True
+
+    def tearDown(self):
+        todo.CONFIG["PLAIN"] = self.plain
+        super(TestList, self).tearDown()
+
     def test_dated(self):
         todo.addm_todo("\n".join(self._test_lines_date(self.num)))
         colored, sorted = todo._list_("date", "#\{(\d{4})-(\d{1,2})-(\d{1,2})\}")
@@ -44,17 +61,243 @@ class TestList(base.BaseTest):
         self.assert_not_equal(colored, sorted)
         self.assert_labeled(colored, sorted)
 
+    def test_group_keys(self):
+        todo.addm_todo("\n".join(["2012-01-02 Made +b", "2012-01-01 Made +a",
+            "(A) Never made +a", "2012-01-01 Again"]))
+        colored, sorted = todo._list_("created")
+        self.assertEqual(sorted[0], "2012-01-01:\n")
+        self.assertEqual(len(sorted), 6)
+        self.assertTrue(sorted[-1].endswith("Never made +a\n"))
+        colored, sorted = todo._list_("project", only=["+a"])
+        self.assertEqual(len(colored), 2)
+        self.assertEqual(sorted[0], "a:\n")
+        self.assertEqual(len(sorted), 3)
+
+    def test_format(self):
+        saved = dict(todo.CONFIG)
+        todo.CONFIG["NO_PRI"] = False
+        try:
+            self.assert_format()
+        finally:
+            todo.CONFIG.update(saved)
+
+    def assert_format(self):
+        task = todo.Task(3, "(A) 2012-01-01 Call +mom @phone #{2012-02-01}")
+        render = todo._compile_format("{num} {pri} {text}")
+        self.assertEqual(render(task, 2), "03 (A) 2012-01-01 Call +mom @phone "
+                "#{2012-02-01}")
+        self.assertEqual(render(todo.Task(3, "Call"), 1), "3 Call")
+        render = todo._compile_format("{due} {pri} {contexts}: {num}")
+        self.assertEqual(render(task, 1), "2012-02-01 (A) @phone: 3")
+        todo.CONFIG["HIDE_PROJ"] = todo.CONFIG["HIDE_DATE"] = True
+        render = todo._compile_format("{text}")
+        self.assertEqual(render(task, 1), "2012-01-01 Call @phone")
+        self.assertRaises(ValueError, todo._compile_format, "{bogus}")
+
+    def test_limit(self):
+        todo.addm_todo("\n".join(self._test_lines_pri(self.num) +
+            self._test_lines_no_pri(self.num)))
+        for legacy in (False, True):
+            todo.CONFIG["LEGACY"] = legacy
+            lines, total = self.capture_listing()
+            try:
+                for (limit, offset) in ((1, 0), (5, 0), (3, 2), (1, 2 * self.num)):
+                    todo.CONFIG["LIMIT"] = limit
+                    todo.CONFIG["OFFSET"] = offset
+                    top, top_total = self.capture_listing()
+                    self.assertEqual(top, lines[offset:offset + limit])
+                    self.assertEqual(top_total, total)
+            finally:
+                todo.CONFIG["LIMIT"] = todo.CONFIG["OFFSET"] = 0
+                todo.CONFIG["LEGACY"] = False
+
+    def test_sort(self):
+        todo.addm_todo("\n".join(["2012-01-02 b +z", "(B) 2012-01-01 c",
+            "a +y", "(A) 2012-01-02 a +y"]))
+        key = todo._sort_key("created,project")
+        tasks = sorted(todo.iter_tasks(), key=key)
+        self.assertEqual([t.number for t in tasks], [2, 4, 1, 3])
+        self.assertEqual(todo._sort_key("pri"), None)
+        self.assertRaises(ValueError, todo._sort_key, "pri,bogus")
+        todo.CONFIG["SORT"] = "text"
+        try:
+            lines, total = self.capture_listing()
+            self.assertEqual([int(l.split()[0]) for l in lines], [2, 4, 1, 3])
+            for (setting, expected) in (("MAX_LINES", lines),
+                    ("LIMIT", lines[:3])):
+                todo.CONFIG[setting] = 3
+                try:
+                    self.assertEqual(self.capture_listing()[0], expected)
+                finally:
+                    todo.CONFIG[setting] = 0
+        finally:
+            todo.CONFIG["SORT"] = ""
+
+    def test_offset(self):
+        todo.addm_todo("\n".join(self._test_lines_pri(self.num)))
+        lines, total = self.capture_listing()
+        todo.CONFIG["OFFSET"] = 5
+        try:
+            self.assertEqual(self.capture_listing(), (lines[5:], total))
+            todo.CONFIG["MAX_LINES"] = 7
+            self.assertEqual(self.capture_listing(), (lines[5:], total))
+        finally:
+            todo.CONFIG["OFFSET"] = todo.CONFIG["MAX_LINES"] = 0
+
+    def run_ls(self, stdout):
+        """todo.run() an ls of many items writing to stdout. Returns its exit
+        status."""
+        todo.addm_todo("\n".join(self._test_lines_no_pri(5000)))
+        sys.stdout = stdout
+        try:
+            todo.run(*todo.opt_setup().parse_args(["ls"]))
+        except SystemExit as e:
+            return e.code
+        finally:
+            sys.stdout = sys.__stdout__
+        return 0
+
+    def test_closed_pipe(self):
+        (r, w) = os.pipe()
+        os.close(r)
+        stdout = os.fdopen(w, "w")
+        try:
+            self.assertEqual(self.run_ls(stdout), 0)
+        finally:
+            stdout.close()
+
+    def test_pager_quit(self):
+        (master, slave) = os.openpty()
+        pager = os.environ.get("PAGER")
+        os.environ["PAGER"] = "true"  # which quits without reading
+        todo.CONFIG["USE_PAGER"] = True
+        stdout = os.fdopen(slave, "w")
+        try:
+            self.assertEqual(self.run_ls(stdout), 0)
+        finally:
+            todo.CONFIG["USE_PAGER"] = False
+            if pager is None:
+                del os.environ["PAGER"]
+            else:
+                os.environ["PAGER"] = pager
+            stdout.close()
+            os.close(master)
+
+    def test_write_lines(self):
+        sys.stdout = StringIO()
+        lines = ["{0}\n".format(i) for i in range(600)]
+        self.assertEqual(todo.write_lines(iter(lines), 256), 600)
+        self.assertEqual(sys.stdout.getvalue(), "".join(lines))
+
     def test_nofile(self):
         os.unlink(todo.CONFIG["TODO_FILE"])
         colored, sorted = todo._list_("pri", None)
 
 
-    # In order to test ./todo.py ls args I'll need a good way of redirecting
-    # stdout so I can capture what it prints.
-    #def test_ls(self):
-    # 	lines = "\n".join(self._test_lines_pri(self.num))
-    # 	lines[-1] = lines[-1] + " I'm looking for this"
-    # 	todo.addm_todo(lines)
+    def test_listing(self):
+        todo.addm_todo("\n".join(self._test_lines_pri(self.num)))
+        formatted = todo.format_lines()
+        expected = []
+        for p in todo.PRIORITIES:
+            expected.extend(formatted[p])
+        self.assertEqual(self.capture_listing(), (expected, self.num))
+
+    def test_bounded_listing(self):
+        todo.addm_todo("\n".join(self._test_lines_pri(self.num)))
+        expected = self.capture_listing()
+        todo.CONFIG["MAX_LINES"] = 7
+        try:
+            self.assertEqual(self.capture_listing(), expected)
+        finally:
+            todo.CONFIG["MAX_LINES"] = 0
+
+    def test_merge_fan_in(self):
+        opened = []
+        temporary_file = todo.TemporaryFile
+
+        def tracked():
+            fd = temporary_file()
+            opened.append(fd)
+            return fd
+
+        items = [((i * 37) % 101, i) for i in range(101)]
+        todo.TemporaryFile = tracked
+        todo._MERGE_FAN_IN = 3
+        try:
+            merged = todo._bounded_sort(iter(items), 2)
+            # Only the last pass's runs are still open.
+            self.assertTrue(len([fd for fd in opened if not fd.closed]) <= 3)
+            self.assertEqual(list(merged), sorted(items))
+        finally:
+            todo.TemporaryFile = temporary_file
+            todo._MERGE_FAN_IN = 64
+        self.assertEqual([fd for fd in opened if not fd.closed], [])
+
+    def test_ls(self):
+        lines = self._test_lines_pri(self.num)
+        lines[-1] = lines[-1] + " I'm looking for this"
+        todo.addm_todo("\n".join(lines))
+        lines, total = self.capture_listing(lambda t: "looking" in t.text)
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(total, self.num)
+
+    def test_term_matcher(self):
+        match = todo.term_matcher(["FOO", "+bar", "foo"])
+        self.assertTrue(match(todo.Task(1, "(A) Foo the +bar")))
+        self.assertFalse(match(todo.Task(1, "(A) Foo the +baz")))
+        self.assertEqual(todo.term_matcher([]), None)
+
+    def test_compile_query(self):
+        match, tags = todo.compile_query(["pri:A-C", "+work", "-@home",
+            "due<today"])
+        self.assertEqual(tags, ["+work"])
+        self.assertTrue(match(todo.Task(1, "(B) Fix +work #{2012-01-01}")))
+        self.assertFalse(match(todo.Task(1, "(D) Fix +work #{2012-01-01}")))
+        self.assertFalse(match(todo.Task(1,
+            "(A) Fix +work @home #{2012-01-01}")))
+        self.assertFalse(match(todo.Task(1, "(A) Fix +work")))
+        match, tags = todo.compile_query(["created>=2012-02-01"])
+        self.assertTrue(match(todo.Task(1, "(A) 2012-02-01 Made")))
+        self.assertFalse(match(todo.Task(1, "2012-01-31 Made")))
+        self.assertFalse(match(todo.Task(1, "Made")))
+        self.assertEqual(todo.compile_query([]), (None, []))
+        self.assertRaises(ValueError, todo.compile_query, ["due<someday"])
+
+    def test_query_argument(self):
+        match, tags = todo.compile_query(["pri:A-C +work -@home due<today"])
+        self.assertEqual(tags, ["+work"])
+        self.assertTrue(match(todo.Task(1, "(B) Fix +work #{2012-01-01}")))
+        self.assertFalse(match(todo.Task(1,
+            "(A) Fix +work @home #{2012-01-01}")))
+        match, tags = todo.compile_query(["buy milk"])
+        self.assertFalse(match(todo.Task(1, "Buy the milk")))
+        for argv in (["ls", "-@home"], ["ls", "-fix", "+work"]):
+            self.assertEqual(todo.opt_setup().parse_args(["-p"] + argv)[1],
+                    argv)
+
+    def test_query_text(self):
+        match, tags = todo.compile_query(["buy milk", "pri:foo", "-due:x"])
+        self.assertEqual(tags, [])
+        self.assertTrue(match(todo.Task(1, "Buy milk, see pri:foo")))
+        self.assertFalse(match(todo.Task(1, "Buy the milk, see pri:foo")))
+        self.assertFalse(match(todo.Task(1, "Buy milk, see pri:foo due:x")))
+
+    def test_query_listing(self):
+        todo.addm_todo("\n".join(self._test_lines_date(self.num)))
+        match, _ = todo.compile_query(["pri:A-B", "due>=tomorrow"])
+        lines, total = self.capture_listing(match)
+        self.assertEqual(total, self.num)
+        numbers = sorted([int(line.split()[0]) for line in lines])
+        n = len(todo.PRIORITIES)
+        self.assertEqual(numbers, [i + 1 for i in range(1, self.num)
+            if todo.PRIORITIES[i % n] in "AB"])
+
+    def capture_listing(self, match=None):
+        sys.stdout = StringIO()
+        shown, total = todo._write_listing(todo.iter_tasks(), match)
+        lines = sys.stdout.getvalue().splitlines(True)
+        self.assertEqual(shown, len(lines))
+        return (lines, total)
 
 
     def assert_dated(self, colored, lines):
@@ -0,0 +1,109 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import fcntl
+import os
+import shutil
+import tempfile
+import unittest
+
+import base
+import todo
+
+class LockTest(base.BaseTest):
+
+    def setUp(self):
+        super(LockTest, self).setUp()
+        todo.CONFIG["LOCK_TIMEOUT"] = 0.2
+        self.holder = open(todo._lock_path(), "a")
+
+    def tearDown(self):
+        self.holder.close()
+        todo.CONFIG["LOCK_TIMEOUT"] = 10
+        super(LockTest, self).tearDown()
+
+    def test_exclusive(self):
+        fcntl.flock(self.holder, fcntl.LOCK_SH)
+        todo.list_todo()
+        self.assertRaises(todo.LockTimeout, todo.add_todo, "Test 1")
+        self.assertEqual(self.count_matches(), 0)
+        self.assertEqual(todo._lock["depth"], 0)
+        fcntl.flock(self.holder, fcntl.LOCK_UN)
+        todo.addm_todo("Test 1\nTest 2")
+        self.assertEqual(self.count_matches(), 2)
+
+    def test_shared(self):
+        fcntl.flock(self.holder, fcntl.LOCK_EX)
+        self.assertRaises(todo.LockTimeout, todo.list_todo)
+        self.assertEqual(todo._lock["fd"], None)
+        valid, args = todo.opt_setup().parse_args(["ls"])
+        self.assertRaises(SystemExit, todo.run, valid, args)
+
+    def test_no_lock_file(self):
+        todo.add_todo("Test 1")
+        todo.CONFIG["LOCK_FILE"] = os.path.join("missing", "todo.lock")
+        try:
+            todo.list_todo()
+            self.assertEqual(todo._lock["fd"], None)
+            self.assertRaises(IOError, todo.add_todo, "Test 2")
+        finally:
+            todo.CONFIG["LOCK_FILE"] = ""
+        self.assertEqual(self.count_matches(), 1)
+
+    def test_read_only(self):
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, "todo.txt"), "w") as fd:
+                fd.write("Test 1\n")
+            os.chmod(path, 0o555)
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    if os.getuid() == 0:
+                        os.setuid(65534)  # nobody, as root can write anywhere
+                    todo.CONFIG["TODO_FILE"] = os.path.join(path, "todo.txt")
+                    todo.list_todo()
+                    status = 0
+                finally:
+                    os._exit(status)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertFalse(os.path.exists(os.path.join(path,
+                "todo.txt.lock")))
+        finally:
+            os.chmod(path, 0o755)
+            shutil.rmtree(path)
+
+    def test_concurrent(self):
+        todo.add_todo("Test")
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                todo.CONFIG["LOCK_TIMEOUT"] = 30
+                for j in range(10):
+                    todo.append_todo(["1", "w{0}{1}".format(i, j)])
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        words = list(todo.iter_todos())[0].split()
+        self.assertEqual(len(words), 41)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -30,6 +30,13 @@ class PrependTest(base.BaseTest):
 
         self.assertNumLines(self.num, "testing\sprepend\sTest\s\d+")
 
+    def test_prepend_done(self):
+        todo.addm_todo("x 2012-01-01 (A) done thing\n(B) Test 1")
+        todo.prepend_todo(["1", "hello"])
+        todo.prepend_todo(["2", "hello"])
+        self.assertNumLines(1, "hello x 2012-01-01 \(A\) done thing$")
+        self.assertNumLines(1, "\(B\) hello Test 1$")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,88 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import os
+import sys
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import base
+import todo
+
+searchtxt = "test_todo.search"
+
+class SearchTest(base.BaseTest):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        todo.CONFIG["SEARCH_INDEX"] = searchtxt
+        self.plain = todo.CONFIG["PLAIN"]
+        todo.CONFIG["PLAIN"] = True
+
+    def tearDown(self):
+        todo.CONFIG["SEARCH_INDEX"] = ""
+        todo.CONFIG["PLAIN"] = self.plain
+        for f in (searchtxt, searchtxt + ".done"):
+            if os.path.isfile(f):
+                os.unlink(f)
+        super(SearchTest, self).tearDown()
+
+    def search(self, query):
+        sys.stdout = StringIO()
+        todo.search_todo(query.split())
+        return sys.stdout.getvalue().splitlines()[:-2]
+
+    def test_index(self):
+        todo.addm_todo("\n".join(self._test_lines_project(self.num)))
+        todo.search_index()
+        todo.prioritize_todo(["4", "C"])
+        todo.add_todo("Call the plumber +home")
+        todo.delete_todo(["1"])
+        grams = todo.search_index()
+        os.unlink(searchtxt)
+        self.assertEqual(grams, todo.search_index())
+
+    def test_done_index(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        todo.do_todo(["1"])
+        (entries, grams) = todo.done_search_index()
+        self.assertEqual(len(entries), 1)
+        todo.do_todo(["1-3"])
+        (entries, grams) = todo.done_search_index()
+        self.assertEqual(len(entries), 4)
+        os.unlink(searchtxt + ".done")
+        self.assertEqual((entries, grams), todo.done_search_index())
+
+    def test_search(self):
+        todo.addm_todo("\n".join(["Call the plumber about the sink",
+            "Buy groceries", "Write the quarterly report",
+            "Fix plumbing leak"]))
+        todo.do_todo(["4"])
+        lines = self.search("plumbr")
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("Call the plumber about the sink"))
+        self.assertTrue(lines[1].endswith("Fix plumbing leak"))
+        lines = self.search("quartrly reprt")
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("3 "))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import unittest
+
+import base
+import todo
+
+class SelectTest(base.BaseTest):
+
+    def setUp(self):
+        super(SelectTest, self).setUp()
+        todo.addm_todo("\n".join(self._test_lines_project(self.num)))
+
+    def test_select(self):
+        selected = todo.select_todos(["3", "5-7", "+work", "1000"])
+        numbers = [3, 5, 6, 7] + list(range(6, self.num + 1, 9))
+        self.assertEqual(sorted(selected), sorted(set(numbers)))
+        self.assertEqual(todo.select_todos(["bogus"]), None)
+
+    def test_do_many(self):
+        todo.do_todo(["1", "3", "10-20"])
+        self.assertNumLines(self.num - 13)
+        self.assertNumLines(0, "\(\w\) Test (0|2|9|1\d)\s")
+
+    def test_pri_range(self):
+        todo.prioritize_todo(["10-19", "b"])
+        self.assertNumLines(10, "\(B\) Test (9|1[0-8])\s")
+        todo.de_prioritize_todo(["10-19"])
+        self.assertNumLines(10, "Test (9|1[0-8])\s")
+
+    def test_del_project(self):
+        todo.delete_todo(["+foo"])
+        self.assertNumLines(self.num - len(range(0, self.num, 9)))
+        self.assertNumLines(0, ".*\+foo")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import os
+import signal
+import sys
+import unittest
+
+import base
+import todo
+
+class ServerTest(base.BaseTest):
+    sock = "test_todo.sock"
+
+    def tearDown(self):
+        if os.path.exists(self.sock):
+            os.unlink(self.sock)
+        super(ServerTest, self).tearDown()
+
+    def request(self, argv, baseline):
+        output = todo.StringIO()
+        status = todo._serve_request(argv, baseline, output)
+        return (status, output.getvalue())
+
+    def test_request(self):
+        baseline = dict(todo.CONFIG)
+        status, output = self.request(["todo.py", "add", "Test 1"], baseline)
+        self.assertEqual(status, 0)
+        self.assertNumLines(1, "Test 1")
+        status, output = self.request(["todo.py", "-p", "ls"], baseline)
+        self.assertEqual(status, 0)
+        self.assertTrue("1 Test 1" in output)
+        status, output = self.request(["todo.py", "bogus"], baseline)
+        self.assertNotEqual(status, 0)
+        self.assertNumLines(1, "Test 1")
+
+    def test_interactive(self):
+        status, output = self.request(["todo.py", "add"], dict(todo.CONFIG))
+        self.assertEqual(status, 1)
+        self.assertTrue("Can't ask for input" in output)
+        self.assertNumLines(0)
+
+    def test_socket_path(self):
+        self.assertEqual(todo._forward_dir(["todo.py", "-d", "a", "ls"]), "a")
+        self.assertEqual(todo._forward_dir(["todo.py", "-db", "ls"]), "b")
+        self.assertEqual(todo._forward_dir(["todo.py", "--dir=c"]), "c")
+        self.assertEqual(todo._forward_dir(["todo.py", "ls"]), "~/.todo")
+        todo.CONFIG["TODO_DIR"] = os.path.abspath("a")
+        try:
+            self.assertEqual(todo._socket_path(),
+                    todo._socket_path(todo._forward_dir(["t", "-d", "a"])))
+        finally:
+            todo.CONFIG["TODO_DIR"] = todo._path("~/.todo")
+
+    def test_serves(self):
+        baseline = dict(todo.CONFIG)
+        baseline["TODO_DIR"] = "a"
+        baseline["TODOTXT_CFG_FILE"] = "b/config"
+        for (directory, served) in (("a", True), ("b", True), ("c", False)):
+            self.assertEqual(todo._serves(os.path.realpath(directory),
+                baseline), served)
+
+    def test_forward(self):
+        self.assertFalse(todo.forward(["todo.py", "-c", "config", "ls"]))
+        os.environ["TODOTXT_SOCKET"] = self.sock
+        try:
+            self.assertFalse(todo.forward(["todo.py", "ls"]))
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    todo.serve()
+                finally:
+                    os._exit(0)
+            self.wait_listening(self.sock)
+            out = "test_server.out"
+            stdout = sys.stdout
+            try:
+                self.assertRaises(SystemExit, todo.forward,
+                        ["todo.py", "add", "Test 2"])
+                self.assertNumLines(1, "Test 2")
+                # A server for another directory leaves it to the client.
+                self.assertFalse(todo.forward(["todo.py", "-d", "elsewhere",
+                    "add", "Test 3"]))
+                self.assertNumLines(1, "Test 2")
+                # A listing longer than one frame arrives whole.
+                todo.addm_todo("\n".join(self._test_lines_no_pri(500)))
+                sys.stdout = open(out, "w")
+                try:
+                    todo.forward(["todo.py", "-p", "ls"])
+                except SystemExit as e:
+                    self.assertEqual(e.code, 0)
+                sys.stdout.close()
+                sys.stdout = stdout
+                with open(out) as fd:
+                    lines = fd.read().splitlines()
+                self.assertEqual(lines[-1], "TODO: 501 of 501 tasks shown")
+                self.assertEqual(len(lines), 503)
+            finally:
+                sys.stdout = stdout
+                if os.path.exists(out):
+                    os.unlink(out)
+                os.kill(pid, signal.SIGINT)
+                os.waitpid(pid, 0)
+        finally:
+            del os.environ["TODOTXT_SOCKET"]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import os
+import sys
+import unittest
+
+import base
+import todo
+
+tagstxt = "test_todo.tags"
+
+class TagIndexTest(base.BaseTest):
+
+    def setUp(self):
+        super(TagIndexTest, self).setUp()
+        todo.CONFIG["TAG_INDEX"] = tagstxt
+
+    def tearDown(self):
+        todo.CONFIG["TAG_INDEX"] = ""
+        if os.path.isfile(tagstxt):
+            os.unlink(tagstxt)
+        super(TagIndexTest, self).tearDown()
+
+    def assert_indexed(self):
+        tags = todo.tag_index()
+        os.unlink(tagstxt)
+        self.assertEqual(tags, todo.tag_index())
+
+    def test_index(self):
+        todo.addm_todo("\n".join(self._test_lines_project(self.num)))
+        todo.add_todo("Test +new @context")
+        tags = todo.tag_index()
+        self.assertEqual(tags["+new"], [self.num + 1])
+        self.assertEqual(sorted(todo.tagged_lines(tags, "+NE")),
+                [self.num + 1])
+        self.assertEqual(todo.tagged_lines(tags, "+missing"), set())
+
+    def test_punctuated(self):
+        todo.addm_todo("Test +work-items\nTest @foo.bar\nTest +work")
+        self.assertEqual(todo.compile_query(["+work-items"])[1], [])
+        self.assertEqual(todo.compile_query(["@foo.bar"])[1], [])
+        self.assertEqual(todo.compile_query(["+work"])[1], ["+work"])
+        for (term, count) in (("+work-items", 1), ("@foo.bar", 1),
+                ("+work", 2)):
+            stdout = sys.stdout
+            sys.stdout = todo.StringIO()
+            try:
+                todo.list_todo([term])
+                shown = sys.stdout.getvalue().splitlines()[-1]
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(shown, "TODO: {0} of 3 tasks shown".format(count))
+
+    def test_refresh(self):
+        todo.addm_todo("\n".join(self._test_lines_project(self.num)))
+        todo.tag_index()
+        todo.prioritize_todo(["4", "C"])
+        todo.add_todo("Test +new @context")
+        self.assert_indexed()
+        todo.do_todo(["2"])
+        todo.delete_todo(["1"])
+        self.assert_indexed()
+
+    def test_read_tasks(self):
+        todo.addm_todo("\n".join(self._test_lines_no_pri(self.num)))
+        tasks = list(todo.read_tasks([3, 1]))
+        self.assertEqual([t.number for t in tasks], [1, 3])
+        self.assertEqual(tasks[1].text, "Test 2")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# TODO.TXT-CLI-python test script
+# Copyright (C) 2011-2012  Sigmavirus24, Jeff Stein
+# 
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+# 
+# TLDR: This is licensed under the GPLv3. See LICENSE for more details.
+
+import datetime
+import unittest
+
+import base
+import todo
+
+class TaskTest(base.BaseTest):
+
+    def test_fields(self):
+        t = todo.Task(3, "(B) 2012-01-02 Call +mom @phone #{2012-1-5}\n")
+        self.assertEqual(t.number, 3)
+        self.assertEqual(t.text, "(B) 2012-01-02 Call +mom @phone #{2012-1-5}")
+        self.assertEqual(t.priority, "B")
+        self.assertEqual(t.created, "2012-01-02")
+        self.assertEqual(t.body, "2012-01-02 Call +mom @phone #{2012-1-5}")
+        self.assertEqual(t.projects, ["mom"])
+        self.assertEqual(t.contexts, ["phone"])
+        self.assertEqual(t.dates, [datetime.date(2012, 1, 5)])
+        self.assertFalse(t.done)
+
+    def test_done(self):
+        t = todo.Task(1, "x 2012-02-03 Call mom")
+        self.assertTrue(t.done)
+        self.assertEqual(t.completed, "2012-02-03")
+        self.assertEqual(t.priority, None)
+        self.assertEqual(t.body, t.text)
+
+    def test_invalid_date(self):
+        t = todo.Task(1, "Test #{2012-13-40}")
+        self.assertEqual(t.dates, [])
+
+    def test_iter_tasks(self):
+        todo.addm_todo("\n".join(self._test_lines_pri(self.num)))
+        tasks = list(todo.iter_tasks())
+        self.assertEqual(len(tasks), self.num)
+        self.assertEqual([t.number for t in tasks], list(range(1, self.num + 1)))
+        self.assertEqual(tasks[0].priority, "A")
+
+if __name__ == "__main__":
+    unittest.main()
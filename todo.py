@@ -18,15 +18,58 @@
 #
 # TLDR: This is licensed under the GPLv3. See LICENSE for more details.
 
+import errno
+import glob
+import heapq
+import json
+import marshal
+import mmap
 import os
 import re
+import socket
+import struct
 import sys
+import traceback
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from functools import partial, wraps
+from itertools import islice
+from locale import getpreferredencoding
+from multiprocessing import Pool, cpu_count
 from optparse import OptionParser
+from shutil import copyfile, copymode
+from subprocess import Popen, PIPE
 from datetime import datetime, date
+from tempfile import TemporaryFile
+from time import sleep, time
 
 VERSION = "development"
 REVISION = "$Id$"
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2 has no asyncio, and so no todo.py api.
+    asyncio = None
+
+try:
+    from urllib.parse import parse_qs, unquote, urlsplit
+except ImportError:
+    # Python 2
+    from urllib import unquote
+    from urlparse import parse_qs, urlsplit
+
+try:
+    import fcntl
+except ImportError:
+    # No locking where there's no fcntl, e.g. on Windows.
+    fcntl = None
+
 try:
     import readline
 except ImportError:
@@ -46,6 +89,19 @@ except NameError:
     # Python 3 renamed raw_input to input
     pass
 
+try:
+    text_type = unicode
+except NameError:
+    # Python 3's str is text
+    text_type = str
+
+try:
+    _replace = os.replace
+except AttributeError:
+    # Python 2 only has rename(), which is atomic on POSIX but won't replace
+    # an existing file on Windows.
+    _replace = os.rename
+
 try:
     from string import uppercase
 except ImportError:
@@ -61,6 +117,10 @@ if os.name == "nt":
     # colorama provides ANSI -> win32 color support
     # If they don't have it, no worries.
 PRIORITIES = uppercase[:24]
+_PRIORITY_RANK = dict([(p, i) for (i, p) in enumerate(PRIORITIES)])
+# The encoding open() uses for the todo files; needed when they're read as
+# bytes to work with offsets.
+ENCODING = getpreferredencoding(False)
 
 # concat() is necessary long before the grouping of function declarations
 concat = lambda str_list, sep='': sep.join([str(i) for i in str_list])
@@ -87,8 +147,27 @@ CONFIG = {
         "TODOTXT_CFG_FILE": _pathc([TODO_DIR, "/config"]),
         "TODO_FILE": _pathc([TODO_DIR, "/todo.txt"]),
         "DONE_FILE": _pathc([TODO_DIR, "/done.txt"]),
+        "TODO_DIRS": "",
         "TMP_FILE": "",
         "REPORT_FILE": "",
+        "INDEX_FILE": "",
+        "CACHE_FILE": "",
+        "TAG_INDEX": "",
+        "LOCK_FILE": "",
+        "API_ADDRESS": "",
+        "JOURNAL_FILE": "",
+        "JOURNAL_COMPACT": 1048576,
+        "LOCK_TIMEOUT": 10,
+        "DATE_INDEX": "",
+        "SEARCH_INDEX": "",
+        "DONE_DIR": "",
+        "DATE_FROM": "",
+        "DATE_TO": "",
+        "MAX_LINES": 0,
+        "LIMIT": 0,
+        "OFFSET": 0,
+        "SORT": "",
+        "OVERDUE": False,
         "USE_GIT": False,
         "PLAIN": False,
         "NO_PRI": False,
@@ -98,6 +177,8 @@ CONFIG = {
         "HIDE_CONT": False,
         "HIDE_DATE": False,
         "LEGACY": False,
+        "USE_PAGER": False,
+        "TODOTXT_FORMAT": "",
         }
 
 
@@ -105,11 +186,199 @@ for p in PRIORITIES:
     CONFIG["PRI_{0}".format(p)] = "default"
 del(p, TODO_DIR)
 
+# Paths waiting to be fsync()'d at the end of the current sync_batch().
+_sync_pending = None
+
+# The in-memory copies of the marshal sidecars kept by serve(), by path; None
+# when not serving.
+_resident = None
+
+# The lock taken by locked(): the open lock file, whether it's exclusive and
+# how many locked() calls deep we are.
+_lock = {"fd": None, "exclusive": False, "depth": 0}
+
+# Line templates compiled by _compile_format(), by their settings.
+_renderers = {}
+
+
+### Task Model
+_UNPARSED = object()
+_selector_re = re.compile('^(\d+)(?:-(\d+))?$')
+_head_re = re.compile(concat(['^(?:x\s(\d{4}-\d{2}-\d{2})\s)?',
+    '(?:\(([A-X])\)\s)?', '(?:(\d{4}-\d{2}-\d{2})\s)?']))
+_project_re = re.compile('\+(\w+)')
+_context_re = re.compile('@(\w+)')
+_date_re = re.compile('#\{(\d{4})-(\d{1,2})-(\d{1,2})\}')
+# The date for each #{yyyy-mm-dd} parsed so far, None where it's invalid.
+_date_memo = {}
+
+
+def _parse_date(ymd):
+    """Return the date for a (yyyy, mm, dd) match of _date_re, or None."""
+    if ymd not in _date_memo:
+        try:
+            _date_memo[ymd] = date(int(ymd[0]), int(ymd[1]), int(ymd[2]))
+        except ValueError:
+            _date_memo[ymd] = None
+    return _date_memo[ymd]
+
+
+class Task(object):
+    """One line of a todo.txt (or done.txt) file.
+
+    Only the line number and the text are stored up front. The head of the
+    line (completion date, priority, creation date) is matched the first time
+    any of those fields is needed, and projects, contexts and dates are each
+    parsed on first access, so a line is never matched by the same regexp
+    twice."""
+    __slots__ = ("number", "text", "_head", "_projects", "_contexts",
+            "_dates")
+
+    def __init__(self, number, text):
+        self.number = number
+        self.text = text.rstrip("\r\n")
+        self._head = _UNPARSED
+        self._projects = _UNPARSED
+        self._contexts = _UNPARSED
+        self._dates = _UNPARSED
+
+    def __repr__(self):
+        return "Task({0!r}, {1!r})".format(self.number, self.text)
+
+    @classmethod
+    def from_record(cls, number, record):
+        """Build a fully parsed Task from the output of record()."""
+        task = cls(number, record[0])
+        task._head = record[1]
+        task._projects = record[2]
+        task._contexts = record[3]
+        task._dates = [date.fromordinal(d) for d in record[4]]
+        return task
+
+    def record(self):
+        """Return every parsed field as a tuple of marshal-able values."""
+        return (self.text, self._parse_head(), self.projects, self.contexts,
+                [d.toordinal() for d in self.dates])
+
+    def _parse_head(self):
+        if self._head is _UNPARSED:
+            self._head = _head_re.match(self.text).groups()
+        return self._head
+
+    @property
+    def done(self):
+        """True if the item has been marked as done ("x yyyy-mm-dd ...")."""
+        return self.text.startswith("x ")
+
+    @property
+    def completed(self):
+        """The completion date string of a done item, or None."""
+        return self._parse_head()[0]
+
+    @property
+    def priority(self):
+        """The priority letter in [A-X], or None."""
+        return self._parse_head()[1]
+
+    @property
+    def created(self):
+        """The creation date string (yyyy-mm-dd) of the item, or None."""
+        return self._parse_head()[2]
+
+    @property
+    def body(self):
+        """The text of the item without its leading priority."""
+        if self.priority and not self.done:
+            return self.text[4:]
+        return self.text
+
+    @property
+    def projects(self):
+        """List of the +projects in the item, without the leading '+'."""
+        if self._projects is _UNPARSED:
+            self._projects = _project_re.findall(self.text)
+        return self._projects
+
+    @property
+    def contexts(self):
+        """List of the @contexts in the item, without the leading '@'."""
+        if self._contexts is _UNPARSED:
+            self._contexts = _context_re.findall(self.text)
+        return self._contexts
+
+    @property
+    def dates(self):
+        """List of datetime.date objects for each #{yyyy-mm-dd} in the item.
+        Invalid dates are skipped."""
+        if self._dates is _UNPARSED:
+            self._dates = [d for d in map(_parse_date,
+                _date_re.findall(self.text)) if d is not None]
+        return self._dates
+### End Task Model
+
 
 ### Helper Functions
-def todo_padding(include_done=False):
-    lines = [line for line in iter_todos(include_done)]
-    i = len(lines)
+def _count_lines(path):
+    """Count the lines in path by counting newlines in large binary reads."""
+    count = 0
+    last = b"\n"
+    try:
+        with open(path, "rb") as fd:
+            chunk = fd.read(1 << 20)
+            while chunk:
+                count += chunk.count(b"\n")
+                last = chunk[-1:]
+                chunk = fd.read(1 << 20)
+    except (IOError, OSError):
+        return 0
+    if last != b"\n":
+        count += 1  # The last line has no newline
+    return count
+
+
+def _file_lines():
+    """Return the number of lines in the todo.txt file itself, without the
+    journaled edits. With INDEX_FILE this is the size of the index;
+    otherwise no lines are built, only newlines counted."""
+    if _index_fresh():
+        size = os.path.getsize(CONFIG["INDEX_FILE"])
+        return (size - _INDEX_HEAD.size) // _OFFSET.size
+    return _count_lines(CONFIG["TODO_FILE"])
+
+
+def _ends_in_newline(path):
+    """Return True if the file at path is empty or ends in a newline."""
+    with open(path, "rb") as fd:
+        fd.seek(0, os.SEEK_END)
+        if not fd.tell():
+            return True
+        fd.seek(-1, os.SEEK_END)
+        return fd.read(1) == b"\n"
+
+
+def count_todos():
+    """Return the number of lines in todo.txt. Journaled edits are counted
+    from the journal alone; see _journal_sizes()."""
+    if _journaled():
+        return _journal_sizes(_journal_edits(), _file_lines())[-1]
+    return _file_lines()
+
+
+def count_done():
+    """Return the number of done items iter_todos(include_done=True) would
+    list. With DONE_DIR and no date range this is read from the manifest."""
+    if CONFIG["DATE_FROM"] or CONFIG["DATE_TO"]:
+        return sum([1 for l in iter_done(CONFIG["DATE_FROM"],
+            CONFIG["DATE_TO"])])
+    if CONFIG["DONE_DIR"]:
+        return sum([count for (_, count) in _read_manifest().values()])
+    if CONFIG["DONE_FILE"]:
+        return _count_lines(CONFIG["DONE_FILE"])
+    return 0
+
+
+def _padding(i):
+    """Return the width needed to print line numbers up to i."""
     pad = 1
     while i >= 10:
         pad += 1
@@ -117,45 +386,307 @@ def todo_padding(include_done=False):
     return pad
 
 
+def todo_padding(include_done=False):
+    i = count_todos()
+    if include_done and i:
+        i += count_done()
+    return _padding(i)
+
+
 def iter_todos(include_done=False):
-    """Opens the file in read-only mode; returns an iterator for the todos."""
-    files = [CONFIG["TODO_FILE"]]
-    if not os.path.isfile(files[0]):
+    """Opens the file in read-only mode; returns an iterator for the todos.
+
+    With include_done the done items completed between --from and --to
+    follow."""
+    if not os.path.isfile(CONFIG["TODO_FILE"]):
         return
-    if include_done and os.path.isfile(CONFIG["DONE_FILE"]):
-        files.append(CONFIG["DONE_FILE"])
-    for f in files:
-        with open(f) as fd:
+    if _journaled():
+        with open(CONFIG["TODO_FILE"]) as fd:
+            for line in _replay(fd.readlines(), _journal_edits()):
+                yield line
+    else:
+        with open(CONFIG["TODO_FILE"]) as fd:
             for line in fd:
                 yield line
+    if include_done:
+        for line in iter_done(CONFIG["DATE_FROM"], CONFIG["DATE_TO"]):
+            yield line
+
+
+def iter_tasks(include_done=False):
+    """Like iter_todos() but yields a Task for each line. Numbering continues
+    from todo.txt into done.txt.
+
+    With CACHE_FILE set, or in a server, the todo.txt items come already
+    parsed from the cache while it matches todo.txt; otherwise the cache is
+    rebuilt once they've all been read."""
+    number = 0
+    cached = CONFIG["CACHE_FILE"] or _resident is not None
+    records = _load_cache() if cached else None
+    if records is not None:
+        for record in records:
+            number += 1
+            yield Task.from_record(number, record)
+    else:
+        stamp = _todo_stamp()
+        fresh = [] if cached and stamp else None
+        for line in iter_todos():
+            number += 1
+            task = Task(number, line)
+            if fresh is not None:
+                fresh.append(task.record())
+            yield task
+        if fresh is not None:
+            _write_cache(stamp, fresh)
+
+    if include_done and os.path.isfile(CONFIG["TODO_FILE"]):
+        for line in iter_done(CONFIG["DATE_FROM"], CONFIG["DATE_TO"]):
+            number += 1
+            yield Task(number, line)
+
+
+def _edited_tail(fd, edits, start):
+    """Yield the lines of the binary file fd from its current position on,
+    the first of which is line start, with edits applied."""
+    for (i, line) in enumerate(fd):
+        new = edits.get(start + i, line)
+        if new is line:
+            yield line
+        elif new is not None:
+            yield new.encode(ENCODING)
+
+
+def _sync(fd, path=None):
+    """When crash-safe writes are enabled (TMP_FILE is set) make sure what was
+    written to fd is on disk. Inside sync_batch() this is deferred until the
+    batch ends, except for a temporary file, which must be on disk before
+    it's renamed into place.
+
+    path -- the name the data will finally live under, if fd is a temporary
+    file."""
+    if not CONFIG["TMP_FILE"]:
+        return
+    fd.flush()
+    if _sync_pending is None or path is not None:
+        os.fsync(fd.fileno())
+    else:
+        _sync_pending.add(fd.name)
+
+
+def _sync_dir(path):
+    """fsync() the directory containing path so a rename into it is durable.
+    Not every platform can open a directory; those are skipped."""
+    if _sync_pending is not None:
+        _sync_pending.add(os.path.dirname(os.path.abspath(path)))
+        return
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    os.close(fd)
 
 
-def separate_line(number):
-    """Takes an integer and returns a string and a list. The string is
-    the item at that position in the list. The list is the rest of the todos.
+def _replace_tmp(tmp, path):
+    """Rename the fsync()'d temporary file tmp over path. When tmp is on
+    another filesystem, where the rename fails with EXDEV, it's first copied
+    into a temporary file next to path."""
+    try:
+        _replace(tmp, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        local = concat([path, ".", os.getpid(), ".tmp"])
+        copyfile(tmp, local)
+        copymode(tmp, local)
+        with open(local, "rb") as fd:
+            os.fsync(fd.fileno())
+        _replace(local, path)
+        os.unlink(tmp)
+
+
+@contextmanager
+def sync_batch():
+    """Defer the fsync() of every append and directory made inside the with
+    block to its end, so that several writes cost a single pass of fsyncs.
+    Each file is still replaced atomically, and only once its new contents
+    are on disk; only the durability of appends and renames waits."""
+    global _sync_pending
+    if _sync_pending is not None:
+        yield
+        return
+    _sync_pending = set()
+    try:
+        yield
+    finally:
+        pending, _sync_pending = _sync_pending, None
+        for path in sorted(pending):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            os.close(fd)
+
+
+def _lock_path():
+    """The file locked() locks: LOCK_FILE, or todo.txt's path plus .lock. The
+    lock can't be on todo.txt itself since atomic writes replace it."""
+    return CONFIG["LOCK_FILE"] or concat([CONFIG["TODO_FILE"], ".lock"])
+
+
+class LockTimeout(Exception):
+    """Raised when todo.txt stays locked by another process for timeout
+    seconds."""
+
+    def __init__(self, timeout):
+        Exception.__init__(self, concat([CONFIG["TODO_FILE"],
+            " is locked by another process; gave up after ", timeout,
+            " seconds."]))
+
+
+def _try_lock(fd, exclusive):
+    """flock() fd without waiting. Returns False if another process holds a
+    lock in the way."""
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    try:
+        fcntl.flock(fd, mode | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
 
-    If the todo.txt file is empty, separate = lines = None. If the number is
-    invalid separate = None, lines != None."""
-    lines = [line for line in iter_todos()]
-    separate = None
-    if lines and number - 1 < len(lines) and 0 <= number - 1:
-        separate = lines.pop(number - 1)
-    return separate, lines
 
+def _acquire(fd, exclusive):
+    """flock() fd, retrying for up to LOCK_TIMEOUT seconds. Raises
+    LockTimeout if the lock couldn't be had in time."""
+    timeout = float(CONFIG["LOCK_TIMEOUT"])
+    deadline = time() + timeout
+    delay = 0.01
+    while not _try_lock(fd, exclusive):
+        if time() >= deadline:
+            raise LockTimeout(timeout)
+        sleep(min(delay, max(deadline - time(), 0)))
+        delay = min(delay * 2, 0.2)
+
+
+def _open_lock(exclusive):
+    """Open the file locked() locks, creating it if need be. Only a shared
+    lock can do without it: for one the file is opened read-only, and None
+    is returned if it can't be opened or created (say, in a directory the
+    user can only read), in which case the command runs unlocked."""
+    if exclusive:
+        return open(_lock_path(), "a")
+    for mode in ("r", "a"):
+        try:
+            return open(_lock_path(), mode)
+        except (IOError, OSError):
+            pass
+    return None
+
+
+def locked(exclusive):
+    """Decorate a command so it runs holding a lock on todo.txt: shared for
+    commands that only read, so any number of them can run at once, and
+    exclusive for those that change it. Nested calls reuse the lock held by
+    the outermost, upgrading it if they need it exclusive."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if fcntl is None:
+                return func(*args, **kwargs)
+            if _lock["depth"] == 0:
+                _lock["fd"] = _open_lock(exclusive)
+                _lock["exclusive"] = False
+            try:
+                if _lock["fd"] is None and exclusive:
+                    _lock["fd"] = _open_lock(exclusive)
+                if _lock["fd"] is not None and (_lock["depth"] == 0 or
+                        (exclusive and not _lock["exclusive"])):
+                    _acquire(_lock["fd"], exclusive)
+                    _lock["exclusive"] = exclusive
+                _lock["depth"] += 1
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    _lock["depth"] -= 1
+            finally:
+                if _lock["depth"] == 0 and _lock["fd"] is not None:
+                    _lock["fd"].close()  # which releases the lock
+                    _lock["fd"] = None
+        return wrapper
+    return decorator
+
+
+def edit_lines(edits):
+    """Change todo.txt. edits maps line numbers to the new line (or None to
+    remove the line).
+
+    If TMP_FILE is set the new file is written there, fsync()'d and renamed
+    over todo.txt so no reader or crash ever sees a partial file. Otherwise
+    todo.txt is changed in place: nothing before the first edited line is
+    rewritten, and when a single line is replaced by one of the same length
+    only that line's bytes are written (through mmap).
+
+    With JOURNAL_FILE set the edits are only appended to the journal; see
+    journal_edit()."""
+    if CONFIG["JOURNAL_FILE"]:
+        journal_edit(edits)
+        return
+    start = min(edits)
+    before = _file_stamp(CONFIG["TODO_FILE"])
+    offset = _line_offset(start) if _line_index_ok() else None
+
+    mode = "rb" if CONFIG["TMP_FILE"] else "r+b"
+    with open(CONFIG["TODO_FILE"], mode) as fd:
+        if offset is None:
+            for (i, offset) in enumerate(_line_starts(fd)):
+                if i + 1 == start:
+                    break
+        fd.seek(offset)
+
+        new = edits[start]
+        new = new.encode(ENCODING) if new is not None else None
+        if CONFIG["TMP_FILE"]:
+            with open(CONFIG["TMP_FILE"], "wb") as tmp:
+                fd.seek(0)
+                remaining = offset
+                while remaining > 0:
+                    chunk = fd.read(min(remaining, 1 << 16))
+                    tmp.write(chunk)
+                    remaining -= len(chunk)
+                tmp.writelines(_edited_tail(fd, edits, start))
+                _sync(tmp, CONFIG["TODO_FILE"])
+        elif len(edits) == 1 and new is not None and \
+                len(fd.readline()) == len(new):
+            m = mmap.mmap(fd.fileno(), 0)
+            m[offset:offset + len(new)] = new
+            m.flush()
+            m.close()
+        else:
+            fd.seek(offset)
+            tail = list(_edited_tail(fd, edits, start))
+            fd.seek(offset)
+            fd.writelines(tail)
+            fd.truncate()
 
-def rewrite_file(fd, lines):
-    """Simple wrapper for three lines used all too frequently. Sets the access
-    position to the beginning of the file, truncates the file's length to 0 and
-    then writes all the lines to the file."""
-    fd.seek(0, 0)
-    fd.truncate(0)
-    fd.writelines(lines)
+    if CONFIG["TMP_FILE"]:
+        copymode(CONFIG["TODO_FILE"], CONFIG["TMP_FILE"])
+        _replace_tmp(CONFIG["TMP_FILE"], CONFIG["TODO_FILE"])
+        _sync_dir(CONFIG["TODO_FILE"])
+    _sync_sidecars(before, start, offset)
 
 
-def rewrite_and_post(line_no, old_line, new_line, lines):
+def rewrite_and_post(line_no, old_line, new_line):
     """Wrapper for frequently used semantics for "post-production"."""
-    with open(CONFIG["TODO_FILE"], "w") as fd:
-        rewrite_file(fd, lines)
+    edit_lines({line_no: new_line})
     post_success(line_no, old_line, new_line)
 
 
@@ -223,6 +754,10 @@ def _git_commit(files, message):
     files -- should be an iterable like ['file_a', 'file_b'] or ['-a']"""
     if len(message) > 49:
         message = concat([message[:45], "...\n\n", message])
+    if CONFIG["JOURNAL_FILE"] and CONFIG["TODO_FILE"] in files and \
+            os.path.isfile(CONFIG["JOURNAL_FILE"]):
+        CONFIG["GIT"].add([CONFIG["JOURNAL_FILE"]])
+        files = files + [CONFIG["JOURNAL_FILE"]]
     try:
         CONFIG["GIT"].commit(files, "-m", message)
     except git.exc.GitCommandError as g:
@@ -244,23 +779,864 @@ def prompt(*args, **kwargs):
     return re.sub(r"\\", "", raw)
 
 
+def write_lines(lines, chunk=256):
+    """Write lines to stdout as they're produced, joined into writes of
+    chunk lines, so the first ones show up just as quickly however many
+    follow. Returns the number of lines written."""
+    write = sys.stdout.write
+    count = 0
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) == chunk:
+            write("".join(buf))
+            count += chunk
+            buf = []
+    write("".join(buf))
+    return count + len(buf)
+
+
+@contextmanager
+def paged(enabled=True):
+    """Send stdout to $PAGER (by default less) for the duration of the block
+    if enabled, USE_PAGER is set and stdout is a terminal."""
+    if not (enabled and CONFIG["USE_PAGER"] and sys.stdout.isatty()):
+        yield
+        return
+    os.environ.setdefault("LESS", "FRX")  # keep the colors, quit if short
+    pager = Popen(os.environ.get("PAGER") or "less", shell=True, stdin=PIPE,
+            universal_newlines=True)
+    stdout = sys.stdout
+    sys.stdout = pager.stdin
+    try:
+        yield
+    except (IOError, OSError) as e:
+        # Quitting the pager early, as q in less does, is no error, just as
+        # todo.py ls | head isn't.
+        if e.errno != errno.EPIPE:
+            raise
+    finally:
+        sys.stdout = stdout
+        try:
+            pager.stdin.close()
+        except (IOError, OSError):
+            pass  # the pager was quit before reading everything
+        pager.wait()
+
+
+def _quiet_stdout():
+    """Point stdout at the null device once the reader of a pipe has gone
+    away, so nothing complains when Python flushes it on exit."""
+    if not hasattr(sys.stdout, "fileno"):
+        return  # not a file, e.g. the output of a command run by serve()
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
 def print_x_of_y(x, y):
+    """x and y are either the lists of lines shown and listed or their
+    lengths."""
     t_str = "--\nTODO: {0} of {1} tasks shown"
-    if len(x) > len(y):  # EXTREMELY hack-ish
-        print(t_str.format(len(y), len(y)))  # There can't logically be
+    x = x if isinstance(x, int) else len(x)
+    y = y if isinstance(y, int) else len(y)
+    if x > y:  # EXTREMELY hack-ish
+        print(t_str.format(y, y))  # There can't logically be
             # more lines of items to do than there actually are.
     else:
-        print(t_str.format(len(x), len(y)))
+        print(t_str.format(x, y))
 
 
-def test_separated(removed, lines, line_no):
-    if not (removed or lines):
+def test_separated(removed, line_no):
+    if removed is None:
         print("{0}: No such todo.".format(line_no))
         return True
     return False
+
+
+def select_todos(selectors):
+    """Resolve selectors against a single snapshot of todo.txt and return a
+    dict mapping each selected line number to its Task, or None if one of the
+    selectors can't be understood.
+
+    A selector is a line NUMBER, a range FIRST-LAST, a +project or an
+    @context. Line NUMBERs that don't exist are reported."""
+    ranges = []
+    tags = []
+    for sel in selectors:
+        r = _selector_re.match(sel)
+        if r:
+            first = int(r.group(1))
+            ranges.append((first, int(r.group(2) or first)))
+        elif sel[:1] in ("+", "@") and sel[1:]:
+            tags.append(sel)
+        else:
+            return None
+
+    selected = {}
+    if not tags and len(ranges) == 1 and ranges[0][0] == ranges[0][1]:
+        # A single line is a seek when INDEX_FILE is enabled.
+        line = read_line(ranges[0][0])
+        if line is not None:
+            selected[ranges[0][0]] = Task(ranges[0][0], line)
+    elif ranges or tags:
+        projects = set([t[1:] for t in tags if t[0] == "+"])
+        contexts = set([t[1:] for t in tags if t[0] == "@"])
+        for task in iter_tasks():
+            for (first, last) in ranges:
+                if first <= task.number <= last:
+                    selected[task.number] = task
+                    break
+            else:
+                if projects.intersection(task.projects) or \
+                        contexts.intersection(task.contexts):
+                    selected[task.number] = task
+
+    for (first, last) in ranges:
+        if first == last:
+            test_separated(selected.get(first), first)
+    return selected
 ### End Helper Functions
 
 
+### Sidecar Functions
+# INDEX_FILE holds a header with the (size, mtime, inode) todo.txt had when
+# the index was written followed by the byte offset of the start of each line
+# as a little-endian unsigned 64-bit integer.
+_INDEX_MAGIC = b"TDX1"
+_INDEX_HEAD = struct.Struct("<4sQdQ")
+_OFFSET = struct.Struct("<Q")
+# CACHE_FILE is a marshal dump of (_CACHE_VERSION, todo.txt stamp, records).
+_CACHE_VERSION = "TDC1"
+# TAG_INDEX is a marshal dump of (_TAG_VERSION, todo.txt stamp, tags) where
+# tags maps each "+project" and "@context" to the line numbers it's on.
+_TAG_VERSION = "TDT1"
+_DATE_VERSION = "TDD1"
+_SEARCH_VERSION = "TDS1"
+_JOURNAL_VERSION = "TDJ1"
+
+
+def _todo_stamp():
+    """Return the _file_stamp() of todo.txt, extended with the size of the
+    journal while there is one, which is what the marshal sidecars are
+    stamped with."""
+    stamp = _file_stamp(CONFIG["TODO_FILE"])
+    if stamp is not None and _journaled():
+        stamp += (os.path.getsize(CONFIG["JOURNAL_FILE"]),)
+    return stamp
+
+
+def _file_stamp(path):
+    """Return (size, mtime, inode) for path or None if it doesn't exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+
+def _line_starts(fd, offset=0):
+    """Yield the byte offset of each line in the binary file fd beginning
+    with the line starting at offset."""
+    fd.seek(offset)
+    for line in fd:
+        yield offset
+        offset += len(line)
+
+
+def _index_stamp():
+    """Return the todo.txt stamp recorded in INDEX_FILE, or None."""
+    try:
+        with open(CONFIG["INDEX_FILE"], "rb") as fd:
+            head = fd.read(_INDEX_HEAD.size)
+    except (IOError, OSError):
+        return None
+    if len(head) < _INDEX_HEAD.size:
+        return None
+    head = _INDEX_HEAD.unpack(head)
+    if head[0] != _INDEX_MAGIC:
+        return None
+    return head[1:]
+
+
+def _write_line_index(stamp, offsets, keep=0):
+    """Replace INDEX_FILE with one stamped for todo.txt at stamp, holding the
+    first keep offsets of the current index followed by offsets. It's
+    written to a temporary file and renamed into place, since readers
+    holding only the shared lock may rebuild it while others read it."""
+    tmp = concat([CONFIG["INDEX_FILE"], ".", os.getpid(), ".tmp"])
+    with open(tmp, "wb") as fd:
+        fd.write(_INDEX_HEAD.pack(_INDEX_MAGIC, *stamp))
+        if keep:
+            with open(CONFIG["INDEX_FILE"], "rb") as old:
+                old.seek(_INDEX_HEAD.size)
+                remaining = keep * _OFFSET.size
+                while remaining > 0:
+                    chunk = old.read(min(remaining, 1 << 16))
+                    if not chunk:
+                        break
+                    fd.write(chunk)
+                    remaining -= len(chunk)
+        for offset in offsets:
+            fd.write(_OFFSET.pack(offset))
+    _replace(tmp, CONFIG["INDEX_FILE"])
+
+
+def build_line_index():
+    """Build INDEX_FILE from scratch by reading all of todo.txt."""
+    stamp = _file_stamp(CONFIG["TODO_FILE"])
+    with open(CONFIG["TODO_FILE"], "rb") as fd:
+        _write_line_index(stamp, _line_starts(fd))
+
+
+def _line_index_ok():
+    """Return True if INDEX_FILE is enabled and describes todo.txt as it is
+    now. The byte offsets are of no use for the line numbers while there
+    are journaled edits."""
+    return not _journaled() and _index_fresh()
+
+
+def _index_fresh():
+    """Return True if INDEX_FILE is enabled and describes the todo.txt file
+    itself, journal or not. A stale index (e.g. todo.txt was edited by hand)
+    is rebuilt."""
+    if not CONFIG["INDEX_FILE"]:
+        return False
+    stamp = _file_stamp(CONFIG["TODO_FILE"])
+    if stamp is None:
+        return False
+    if _index_stamp() != stamp:
+        build_line_index()
+    return True
+
+
+def _line_offset(number):
+    """Return the byte offset of line number from a valid INDEX_FILE, or None
+    if there is no such line."""
+    if number < 1:
+        return None
+    with open(CONFIG["INDEX_FILE"], "rb") as fd:
+        fd.seek(_INDEX_HEAD.size + (number - 1) * _OFFSET.size)
+        data = fd.read(_OFFSET.size)
+    if len(data) < _OFFSET.size:
+        return None
+    return _OFFSET.unpack(data)[0]
+
+
+def read_line(number):
+    """Return line number of todo.txt (with its newline) or None if there is
+    no such line. When INDEX_FILE is enabled this is a seek, not a scan.
+    While edits are journaled the line is looked up through the journal
+    (see _journal_line()) rather than by replaying it over all of todo.txt."""
+    if number < 1:
+        return None
+    if _journaled():
+        journal = _journal_edits()
+        sizes = _journal_sizes(journal, _file_lines())
+        line, number = _journal_line(number, journal, sizes)
+        if number is None:
+            return line
+    if _index_fresh():
+        offset = _line_offset(number)
+        if offset is None:
+            return None
+        with open(CONFIG["TODO_FILE"], "rb") as fd:
+            fd.seek(offset)
+            return fd.readline().decode(ENCODING)
+    with open(CONFIG["TODO_FILE"]) as fd:
+        for (i, line) in enumerate(fd):
+            if i + 1 == number:
+                return line
+    return None
+
+
+def _load_marshal(path, version, stamp=None):
+    """Return the data in a marshal sidecar if it was written for todo.txt as
+    it is now (or as it was at stamp), else None. A server (see serve())
+    keeps the sidecars in memory."""
+    if stamp is None:
+        stamp = _todo_stamp()
+    if _resident is not None and path in _resident:
+        sidecar = _resident[path]
+    elif not path:
+        return None
+    else:
+        try:
+            with open(path, "rb") as fd:
+                sidecar = marshal.load(fd)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if _resident is not None:
+            _resident[path] = sidecar
+    if sidecar[0] != version or tuple(sidecar[1]) != stamp:
+        return None
+    return sidecar[2]
+
+
+def _write_marshal(path, version, stamp, data):
+    """Replace a marshal sidecar with data for todo.txt at stamp. Without a
+    path the data is only kept in a server's memory."""
+    if _resident is not None:
+        _resident[path] = (version, stamp, data)
+    if not path:
+        return
+    tmp = concat([path, ".", os.getpid(), ".tmp"])
+    with open(tmp, "wb") as fd:
+        marshal.dump((version, stamp, data), fd)
+    _replace(tmp, path)
+
+
+def _load_cache(stamp=None):
+    """Return the parsed records (see Task.record()) stored in CACHE_FILE if
+    it was written for todo.txt as it is now (or as it was at stamp), else
+    None."""
+    return _load_marshal(CONFIG["CACHE_FILE"], _CACHE_VERSION, stamp)
+
+
+def _write_cache(stamp, records):
+    """Replace CACHE_FILE with records for todo.txt at stamp."""
+    _write_marshal(CONFIG["CACHE_FILE"], _CACHE_VERSION, stamp, records)
+
+
+def _task_tags(task):
+    """Return the set of +projects and @contexts in task."""
+    return set(["+" + p for p in task.projects] +
+            ["@" + c for c in task.contexts])
+
+
+def tag_index():
+    """Return {tag: sorted line numbers} for every +project and @context in
+    todo.txt, or None if TAG_INDEX isn't set. A stale index is rebuilt."""
+    if not CONFIG["TAG_INDEX"]:
+        return None
+    stamp = _todo_stamp()
+    if stamp is None:
+        return {}
+    tags = _load_marshal(CONFIG["TAG_INDEX"], _TAG_VERSION, stamp)
+    if tags is None:
+        tags = {}
+        for task in iter_tasks():
+            for tag in _task_tags(task):
+                tags.setdefault(tag, []).append(task.number)
+        _write_marshal(CONFIG["TAG_INDEX"], _TAG_VERSION, stamp, tags)
+    return tags
+
+
+def tagged_lines(index, term):
+    """Return the set of line numbers in index (see tag_index()) having a tag
+    that starts with term, ignoring case. "+work" finds +work and +workshop,
+    just as the substring search in ls does."""
+    term = term.lower()
+    numbers = set()
+    for (tag, lines) in index.items():
+        if tag.lower().startswith(term):
+            numbers.update(lines)
+    return numbers
+
+
+def _dated(tasks):
+    """Return the sorted (date ordinal, line number) pairs of tasks."""
+    pairs = []
+    for task in tasks:
+        for ordinal in set([d.toordinal() for d in task.dates]):
+            pairs.append((ordinal, task.number))
+    pairs.sort()
+    return pairs
+
+
+def date_index():
+    """Return the (date ordinals, line numbers) lists of every #{yyyy-mm-dd}
+    in todo.txt, sorted by date. With DATE_INDEX set it's kept in that file
+    and rebuilt when stale; otherwise it's built each time."""
+    stamp = _todo_stamp()
+    if stamp is None:
+        return ([], [])
+    index = None
+    if CONFIG["DATE_INDEX"]:
+        index = _load_marshal(CONFIG["DATE_INDEX"], _DATE_VERSION, stamp)
+    if index is None:
+        pairs = _dated(iter_tasks())
+        index = ([o for (o, _) in pairs], [n for (_, n) in pairs])
+        if CONFIG["DATE_INDEX"]:
+            _write_marshal(CONFIG["DATE_INDEX"], _DATE_VERSION, stamp, index)
+    return index
+
+
+def dated_lines(index, since=None, until=None):
+    """Return the set of line numbers in index (see date_index()) having a
+    date between the dates since and until, inclusive. Either may be None.
+    Only the part of the index in the range is looked at."""
+    (ordinals, numbers) = index
+    low = bisect_left(ordinals, since.toordinal()) if since else 0
+    high = bisect_right(ordinals, until.toordinal()) if until else \
+            len(ordinals)
+    return set(numbers[low:high])
+
+
+def read_tasks(numbers):
+    """Yield the Tasks on the given line numbers of todo.txt in order. Only
+    those lines are parsed; with CACHE_FILE or INDEX_FILE only those lines
+    are read."""
+    numbers = sorted(numbers)
+    records = _load_cache() if CONFIG["CACHE_FILE"] or \
+            _resident is not None else None
+    if records is not None:
+        for n in numbers:
+            if 0 < n <= len(records):
+                yield Task.from_record(n, records[n - 1])
+    elif _line_index_ok():
+        with open(CONFIG["TODO_FILE"], "rb") as fd:
+            for n in numbers:
+                offset = _line_offset(n)
+                if offset is not None:
+                    fd.seek(offset)
+                    yield Task(n, fd.readline().decode(ENCODING))
+    else:
+        wanted = set(numbers)
+        for (i, line) in enumerate(iter_todos()):
+            if i + 1 in wanted:
+                yield Task(i + 1, line)
+
+
+def _patch_postings(postings, start, keyed):
+    """Drop the line numbers from start on from postings, a {key: sorted
+    line numbers} index, then add the (number, keys) pairs of keyed."""
+    for key in list(postings.keys()):
+        del(postings[key][bisect_left(postings[key], start):])
+        if not postings[key]:
+            del(postings[key])
+    for (number, keys) in keyed:
+        for key in keys:
+            postings.setdefault(key, []).append(number)
+
+
+def _sync_sidecars(before, start, offset):
+    """Bring the sidecar files up to date after a write replaced everything in
+    todo.txt from line start (at byte offset) onward.
+
+    before -- the _file_stamp() of todo.txt taken before the write. A sidecar
+    that didn't match it is rebuilt (or, for the cache and the tag, date and
+    search indexes, left to be rebuilt by the next read) rather than
+    patched. While edits are journaled line numbers don't match todo.txt, so
+    the sidecars are left to be rebuilt."""
+    stamp = _file_stamp(CONFIG["TODO_FILE"])
+    if stamp is None or _journaled():
+        return
+    index = CONFIG["INDEX_FILE"] and _index_stamp() == before
+    cache = _load_cache(before) if CONFIG["CACHE_FILE"] or \
+            _resident is not None else None
+    tags = dates = grams = None
+    if CONFIG["TAG_INDEX"]:
+        tags = _load_marshal(CONFIG["TAG_INDEX"], _TAG_VERSION, before)
+    if CONFIG["DATE_INDEX"]:
+        dates = _load_marshal(CONFIG["DATE_INDEX"], _DATE_VERSION, before)
+    if CONFIG["SEARCH_INDEX"]:
+        grams = _load_marshal(CONFIG["SEARCH_INDEX"], _SEARCH_VERSION, before)
+    patched = (cache, tags, dates, grams)
+    if not index:
+        if CONFIG["INDEX_FILE"]:
+            build_line_index()
+        if patched == (None,) * 4:
+            return
+
+    with open(CONFIG["TODO_FILE"], "rb") as fd:
+        fd.seek(offset)
+        tail = fd.readlines()
+
+    if index:
+        offsets = []
+        for line in tail:
+            offsets.append(offset)
+            offset += len(line)
+        _write_line_index(stamp, offsets, start - 1)
+    if patched == (None,) * 4:
+        return
+
+    tail = [Task(start + i, line.decode(ENCODING))
+            for (i, line) in enumerate(tail)]
+    if cache is not None:
+        cache = cache[:start - 1]
+        cache.extend([task.record() for task in tail])
+        _write_cache(stamp, cache)
+    if tags is not None:
+        _patch_postings(tags, start, [(t.number, _task_tags(t)) for t in tail])
+        _write_marshal(CONFIG["TAG_INDEX"], _TAG_VERSION, stamp, tags)
+    if grams is not None:
+        _patch_postings(grams, start,
+                [(t.number, _trigrams(t.text)) for t in tail])
+        _write_marshal(CONFIG["SEARCH_INDEX"], _SEARCH_VERSION, stamp, grams)
+    if dates is not None:
+        pairs = [p for p in zip(*dates) if p[1] < start] + _dated(tail)
+        pairs.sort()
+        dates = ([o for (o, _) in pairs], [n for (_, n) in pairs])
+        _write_marshal(CONFIG["DATE_INDEX"], _DATE_VERSION, stamp, dates)
+### End Sidecar Functions
+
+
+### Journal Functions
+# With JOURNAL_FILE set edit_lines() doesn't touch todo.txt: each call appends
+# its edits to the journal as one marshal record, after a header record with
+# the inode, size and mtime of the todo.txt they apply to. Readers replay the
+# journal over todo.txt until compact_journal() writes the result out as a
+# new todo.txt. As that replaces todo.txt the old journal no longer applies,
+# even if a crash leaves it behind, and neither does it once todo.txt is
+# changed any other way; such a journal is set aside and reported. So while
+# there's a journal new items go into it too, as edits numbered past the
+# last line.
+def _journaled():
+    """Return True if there's a journal to replay."""
+    return bool(CONFIG["JOURNAL_FILE"]) and \
+            os.path.isfile(CONFIG["JOURNAL_FILE"]) and \
+            os.path.getsize(CONFIG["JOURNAL_FILE"]) > 0
+
+
+def _journal_head():
+    """The header a journal for todo.txt as it is now starts with: its inode,
+    size and mtime."""
+    stamp = _file_stamp(CONFIG["TODO_FILE"])
+    if stamp is None:
+        return None
+    return (_JOURNAL_VERSION, stamp[2], stamp[0], stamp[1])
+
+
+def _journal_edits():
+    """Return the list of edits in the journal that apply to todo.txt. A
+    torn record at the end (from a crash mid-append) is ignored, and a
+    journal for another todo.txt is set aside; see _set_journal_aside()."""
+    if not _journaled():
+        return []
+    edits = []
+    stale = False
+    with open(CONFIG["JOURNAL_FILE"], "rb") as fd:
+        try:
+            stale = tuple(marshal.load(fd)) != _journal_head()
+            while not stale:
+                edits.append(marshal.load(fd))
+        except (EOFError, ValueError, TypeError):
+            pass
+    if stale:
+        _set_journal_aside()
+        return []
+    return edits
+
+
+def _set_journal_aside():
+    """Move a journal that no longer applies, since todo.txt was changed some
+    other way, to a name of its own and say so. Its edits aren't replayed,
+    but they aren't lost to the next journal either."""
+    path = CONFIG["JOURNAL_FILE"]
+    aside = concat([path, ".", datetime.now().strftime("%Y%m%d%H%M%S"), ".",
+        os.getpid()])
+    try:
+        os.rename(path, aside)
+    except OSError:
+        return  # another reader got to it first
+    print(concat(["TODO: ", CONFIG["TODO_FILE"], " was changed outside of ",
+        "todo.py, so the journaled changes not yet compacted into it no ",
+        "longer apply. They were moved to ", aside, "."]))
+
+
+def _replay(lines, journal):
+    """Apply each of the edits in journal (see edit_lines()) to the list of
+    lines in turn and return it. Edits numbered past the last line are new
+    items, added in order."""
+    for edits in journal:
+        size = len(lines)
+        for n in sorted(edits, reverse=True):
+            if 0 < n <= size:
+                if edits[n] is None:
+                    del(lines[n - 1])
+                else:
+                    lines[n - 1] = edits[n]
+        lines.extend([edits[n] for n in sorted(edits)
+            if n > size and edits[n] is not None])
+    return lines
+
+
+def _journal_sizes(journal, size):
+    """Return the number of lines there are before each of the edits in
+    journal is replayed over size lines, followed by the number after the
+    last of them."""
+    sizes = [size]
+    for edits in journal:
+        size = sizes[-1]
+        deleted = len([n for n in edits if edits[n] is None and 0 < n <= size])
+        added = len([n for n in edits if edits[n] is not None and n > size])
+        sizes.append(size - deleted + added)
+    return sizes
+
+
+def _journal_line(number, journal, sizes):
+    """Find line number of todo.txt with journal replayed over it by going
+    back through the edits, the last first, rather than replaying them.
+    sizes is from _journal_sizes(). Returns (line, None) for a line one of
+    the edits wrote, (None, n) for line n of the todo.txt file itself, or
+    (None, None) if there's no such line."""
+    for i in range(len(journal) - 1, -1, -1):
+        if not 0 < number <= sizes[i + 1]:
+            return (None, None)
+        edits, size = journal[i], sizes[i]
+        deleted = sorted([n for n in edits if edits[n] is None and
+            0 < n <= size])
+        kept = size - len(deleted)
+        if number > kept:
+            added = sorted([n for n in edits if edits[n] is not None and
+                n > size])
+            return (edits[added[number - kept - 1]], None)
+        # The line's number before the lines ahead of it were deleted.
+        for n in deleted:
+            if n > number:
+                break
+            number += 1
+        if edits.get(number) is not None:
+            return (edits[number], None)
+    if 0 < number <= sizes[0]:
+        return (None, number)
+    return (None, None)
+
+
+def journal_edit(edits):
+    """Append edits to the journal, starting a new one if there's none for
+    todo.txt as it is. Once the journal is over JOURNAL_COMPACT bytes it's
+    compacted."""
+    path = CONFIG["JOURNAL_FILE"]
+    head = _journal_head()
+    fresh = True
+    if _journaled():
+        with open(path, "rb") as fd:
+            try:
+                fresh = tuple(marshal.load(fd)) != head
+            except (EOFError, ValueError, TypeError):
+                pass
+            else:
+                if fresh:
+                    _set_journal_aside()
+    with open(path, "wb" if fresh else "ab") as fd:
+        if fresh:
+            marshal.dump(head, fd)
+        marshal.dump(edits, fd)
+        _sync(fd)
+    limit = int(CONFIG["JOURNAL_COMPACT"])
+    if limit and os.path.getsize(path) > limit:
+        compact_journal()
+
+
+def compact_journal():
+    """Write todo.txt with the journal applied over it and remove the journal.
+    Returns False if there was nothing to compact."""
+    if not _journaled():
+        return False
+    # The last line of todo.txt may lack its newline, and now be followed.
+    lines = [l if l.endswith("\n") else concat([l, "\n"])
+            for l in iter_todos()]
+    tmp = concat([CONFIG["TODO_FILE"], ".", os.getpid(), ".tmp"])
+    with open(tmp, "w") as fd:
+        fd.writelines(lines)
+        _sync(fd, CONFIG["TODO_FILE"])
+    copymode(CONFIG["TODO_FILE"], tmp)
+    _replace(tmp, CONFIG["TODO_FILE"])
+    _sync_dir(CONFIG["TODO_FILE"])
+    os.unlink(CONFIG["JOURNAL_FILE"])
+    return True
+
+
+@usage('\tcompact',
+    '\t\tWith JOURNAL_FILE set, writes the journaled changes into todo.txt',
+    '\t\tand empties the journal.\n')
+@locked(True)
+def compact():
+    """Fold the journal into todo.txt."""
+    if compact_journal():
+        print("TODO: The journal was compacted into todo.txt.")
+        if CONFIG["USE_GIT"]:
+            _git_commit([CONFIG["TODO_FILE"]], "Compacted the journal.")
+    else:
+        print("TODO: There's no journal to compact.")
+### End Journal Functions
+
+
+### Done Archive Functions
+# With DONE_DIR set, done items are archived in one segment file per month of
+# completion (done-yyyy-mm.txt) and DONE_DIR/manifest lists each segment as
+# "yyyy-mm filename count". Items without a completion date go in
+# done-undated.txt under the month "0000-00".
+def _segment_month(line):
+    """Return the yyyy-mm a done line belongs to."""
+    completed = Task(0, line).completed
+    return completed[:7] if completed else "0000-00"
+
+
+def _read_manifest():
+    """Return {month: [filename, count]} for the segments in DONE_DIR. The
+    manifest is rebuilt from the segment files if it's missing."""
+    manifest = {}
+    path = _pathc([CONFIG["DONE_DIR"], "/manifest"])
+    if os.path.isfile(path):
+        with open(path) as fd:
+            for line in fd:
+                (month, name, count) = line.split()
+                manifest[month] = [name, int(count)]
+    elif os.path.isdir(CONFIG["DONE_DIR"]):
+        segment_re = re.compile('^done-(\d{4}-\d{2}|undated)\.txt$')
+        for name in os.listdir(CONFIG["DONE_DIR"]):
+            r = segment_re.match(name)
+            if r:
+                month = r.group(1).replace("undated", "0000-00")
+                with open(_pathc([CONFIG["DONE_DIR"], "/", name])) as fd:
+                    manifest[month] = [name, len(fd.readlines())]
+        if manifest:
+            _write_manifest(manifest)
+    return manifest
+
+
+def _write_manifest(manifest):
+    path = _pathc([CONFIG["DONE_DIR"], "/manifest"])
+    with open(concat([path, ".tmp"]), "w") as fd:
+        for month in sorted(manifest):
+            fd.write("{0} {1} {2}\n".format(month, *manifest[month]))
+        _sync(fd, path)
+    _replace(concat([path, ".tmp"]), path)
+
+
+def archive_done(lines):
+    """Append done lines to the segments of the months they were completed
+    in. Returns the paths that were written to."""
+    if not os.path.isdir(CONFIG["DONE_DIR"]):
+        os.makedirs(CONFIG["DONE_DIR"])
+    manifest = _read_manifest()
+    by_month = {}
+    for line in lines:
+        by_month.setdefault(_segment_month(line), []).append(line)
+
+    written = []
+    for month in sorted(by_month):
+        if month not in manifest:
+            name = "done-undated.txt" if month == "0000-00" else \
+                    "done-{0}.txt".format(month)
+            manifest[month] = [name, 0]
+        path = _pathc([CONFIG["DONE_DIR"], "/", manifest[month][0]])
+        with open(path, "a") as fd:
+            fd.writelines(by_month[month])
+            _sync(fd)
+        manifest[month][1] += len(by_month[month])
+        written.append(path)
+
+    _write_manifest(manifest)
+    written.append(_pathc([CONFIG["DONE_DIR"], "/manifest"]))
+    return written
+
+
+def _remove_segments():
+    """Delete the segments and the manifest in DONE_DIR, and DONE_DIR itself
+    if that leaves it empty. Returns the paths deleted."""
+    paths = [_pathc([CONFIG["DONE_DIR"], "/", name])
+            for (name, _) in _read_manifest().values()]
+    paths.append(_pathc([CONFIG["DONE_DIR"], "/manifest"]))
+    removed = []
+    for path in paths:
+        if os.path.isfile(path):
+            os.unlink(path)
+            removed.append(path)
+    try:
+        os.rmdir(CONFIG["DONE_DIR"])
+    except OSError:
+        pass
+    return removed
+
+
+def _done_files(since="", until=""):
+    """Return the paths of the files holding the done items completed between
+    the months of since and until, oldest first."""
+    if CONFIG["DONE_DIR"]:
+        manifest = _read_manifest()
+        return [_pathc([CONFIG["DONE_DIR"], "/", manifest[m][0]])
+                for m in sorted(manifest)
+                if m == "0000-00" or ((not since or m >= since[:7]) and
+                    (not until or m <= until[:7]))]
+    elif CONFIG["DONE_FILE"]:
+        return [CONFIG["DONE_FILE"]]
+    return []
+
+
+def iter_done(since="", until=""):
+    """Iterate over the done items completed between since and until
+    (yyyy-mm or yyyy-mm-dd, both inclusive and optional). With DONE_DIR only
+    the segments for those months are opened."""
+    def in_range(key):
+        return (not since or key[:len(since)] >= since) and \
+                (not until or key[:len(until)] <= until)
+
+    for f in _done_files(since, until):
+        if not os.path.isfile(f):
+            continue
+        with open(f) as fd:
+            for line in fd:
+                if since or until:
+                    completed = Task(0, line).completed
+                    if completed and not in_range(completed):
+                        continue
+                yield line
+
+
+@usage('\tarchive split | flat',
+    '\t\tWith DONE_DIR set, "split" moves the items in done.txt into the',
+    '\t\tmonthly segments in DONE_DIR and "flat" moves every segment back',
+    '\t\tinto a single done.txt.\n')
+@locked(True)
+def archive(args):
+    """Convert between a flat done.txt and the segments in DONE_DIR."""
+    action = args[0].lower() if args else ""
+    if not CONFIG["DONE_DIR"] or not CONFIG["DONE_FILE"] or \
+            action not in ("split", "flat"):
+        print(concat(["Usage: ", CONFIG["TODO_PY"], " archive (split|flat)",
+            " with both DONE_DIR and DONE_FILE set."]))
+        return
+
+    if action == "split":
+        lines = []
+        if os.path.isfile(CONFIG["DONE_FILE"]):
+            with open(CONFIG["DONE_FILE"]) as fd:
+                lines = fd.readlines()
+        with sync_batch():
+            files = archive_done(lines)
+            open(CONFIG["DONE_FILE"], "w").close()
+        s = "TODO: {0} done items moved into {1}.".format(len(lines),
+                CONFIG["DONE_DIR"])
+    else:
+        count = 0
+        path = concat([CONFIG["DONE_FILE"], ".tmp"])
+        with open(path, "w") as fd:
+            # Anything done.txt still has is from before DONE_DIR was set.
+            if os.path.isfile(CONFIG["DONE_FILE"]):
+                with open(CONFIG["DONE_FILE"]) as done:
+                    for line in done:
+                        fd.write(line)
+                        count += 1
+            for line in iter_done():
+                fd.write(line)
+                count += 1
+            _sync(fd, CONFIG["DONE_FILE"])
+        _replace(path, CONFIG["DONE_FILE"])
+        _sync_dir(CONFIG["DONE_FILE"])
+        # Left behind, the segments would be added to done.txt again by the
+        # next split.
+        files = []
+        removed = _remove_segments()
+        s = "TODO: {0} done items written to {1}.".format(count,
+                CONFIG["DONE_FILE"])
+
+    print(s)
+    if CONFIG["USE_GIT"]:
+        files.append(CONFIG["DONE_FILE"])
+        CONFIG["GIT"].add(files)
+        if action == "flat" and removed:
+            CONFIG["GIT"].rm("--cached", "--ignore-unmatch", "-q", "--",
+                    *removed)
+            files.extend(removed)
+        _git_commit(files, s)
+### End Done Archive Functions
+
+
 ### Configuration Functions
 def _iter_actual_lines_(config_file):
     """Return only the actual lines of the config file. This skips commented or
@@ -296,18 +1672,25 @@ def get_config(config_name="", dir_name=""):
         not config_name:
         default_config()
     else:
-        strip_re = re.compile('\w+\s([A-Za-z_\\\\:$="./01]+).*')
+        strip_re = re.compile(
+                '\w+\s(\w+="[^"]*"|[A-Za-z_\\\\:$="./0-9]+).*')
         pri_re = re.compile('(PRI_[A-X]|DEFAULT)')
+        number_re = re.compile('^[0-9]+(\.[0-9]+)?$')
 
         for line in _iter_actual_lines_(config_file):
             # Extract VAR=VAL and then split VAR and VAL
-            var = strip_re.sub('\g<1>', line.strip()).split('=')
+            var = strip_re.sub('\g<1>', line.strip()).split('=', 1)
             var[1] = var[1].strip('"')
 
-            if var[1] in ("True", "1"):
+            default = CONFIG.get(var[0])
+            if isinstance(default, bool) and var[1] in ("True", "1"):
                 CONFIG[var[0]] ^= True
-            elif var[1] in ("False", "0"):
+            elif isinstance(default, bool) and var[1] in ("False", "0"):
                 CONFIG[var[0]] ^= False
+            elif type(default) is int and number_re.match(var[1]):
+                # A count or a size, or a LOCK_TIMEOUT in seconds
+                CONFIG[var[0]] = float(var[1]) if "." in var[1] else \
+                        int(var[1])
             elif pri_re.match(var[0]):
                 CONFIG[var[0]] = var[1].strip('$').lower().replace('_', ' ')
             else:
@@ -499,6 +1882,7 @@ def default_config():
        concat(["\t\tAdds 'Item to do +project @context #{yyyy-mm-dd}'",
        "to your todo.txt"], ' '), "\t\tfile.",
        "\t\t+project, @context, #{yyyy-mm-dd} are optional\n")
+@locked(True)
 def add_todo(args):
     """Add a new item to the list of things todo."""
     if str(args) == args:
@@ -509,28 +1893,43 @@ def add_todo(args):
         line = prompt("Add:")
 
     prepend = CONFIG["PRE_DATE"]
-    l = len([1 for l in iter_todos()]) + 1
-    pri_re = re.compile('(\([A-X]\))')
+    l = count_todos() + 1
 
-    if pri_re.match(line) and prepend:
-        line = pri_re.sub(concat(["\g<1>",
-            datetime.now().strftime(" %Y-%m-%d ")]), line)
-    elif prepend:
-        line = concat([datetime.now().strftime("%Y-%m-%d "), line])
+    if prepend:
+        task = Task(l, line)
+        today = datetime.now().strftime("%Y-%m-%d ")
+        if task.priority and not task.done:
+            line = concat([line[:4], today, line[4:]])
+        else:
+            line = concat([today, line])
 
-    with open(CONFIG["TODO_FILE"], "a") as fd:
-        fd.write(concat([line, "\n"]))
+    if _journaled():
+        # todo.txt has to stay as the journal's header recorded it.
+        journal_edit({l: concat([line, "\n"])})
+    else:
+        before = _file_stamp(CONFIG["TODO_FILE"])
+        offset = before[0] if before else 0
+        with open(CONFIG["TODO_FILE"], "a") as fd:
+            if offset and not _ends_in_newline(CONFIG["TODO_FILE"]):
+                # or the item would be run into the last line
+                fd.write("\n")
+                offset += 1
+            fd.write(concat([line, "\n"]))
+            _sync(fd)
+        _sync_sidecars(before, l, offset)
 
     s = "TODO: '{0}' added on line {1}.".format(line, l)
     print(s)
     if CONFIG["USE_GIT"]:
         _git_commit([CONFIG["TODO_FILE"]], s)
+    return l
 
 
 @usage('\taddm "First item to do +project @context #{yyyy-mm-dd}',
     '\t\tSecond item to do +project @context #{yyyy-mm-dd}',
     '\t\t...', '\t\tLast item to do +project @context #{yyyy-mm-dd}',
     '\t\tAdds each line as a separate item to your todo.txt file.\n')
+@locked(True)
 def addm_todo(args):
     """Add new items to the list of things todo."""
     if str(args) == args:
@@ -538,62 +1937,74 @@ def addm_todo(args):
     else:
         lines = concat(args, " ")
     lines = lines.split("\n")
-    list(map(add_todo, lines))  # Python 3 requirement
+    with sync_batch():
+        list(map(add_todo, lines))  # Python 3 requirement
 ### End new todo functions
 
 
 ### Start do/del functions
-@usage('\tdo NUMBER',
-    '\t\tMarks item with corresponding number as done and moves it to',
-    '\t\tyour done.txt file.\n')
-def do_todo(line):
-    """Mark an item on a specified line as done."""
-    if not line.isdigit():
-        print("Usage: {0} do item#".format(CONFIG["TODO_PY"]))
-    else:
-        removed, lines = separate_line(int(line))
-        if test_separated(removed, lines, line):
-            return
-
-        fd = open(CONFIG["TODO_FILE"], "w")
-        rewrite_file(fd, lines)
-        fd.close()
+@usage('\tdo NUMBER [NUMBER ...]',
+    '\t\tMarks items with corresponding numbers as done and moves them to',
+    '\t\tyour done.txt file. Instead of a NUMBER, do, del, pri and depri',
+    '\t\taccept a range FIRST-LAST, a +project or an @context.\n')
+@locked(True)
+def do_todo(args):
+    """Mark the items selected by args as done."""
+    if str(args) == args:
+        args = [args]
+    selected = select_todos(args)
+    if not selected:
+        if selected is None or not args:
+            print("Usage: {0} do item#".format(CONFIG["TODO_PY"]))
+        return
 
-        today = datetime.now().strftime("%Y-%m-%d")
-        removed = concat(["x", today,
-            re.sub("\([A-X]\)\s?", "", removed)], " ")
+    today = datetime.now().strftime("%Y-%m-%d")
+    numbers = sorted(selected)
+    removed = [concat([concat(["x", today, selected[n].body], " "),
+        "\n"]) for n in numbers]
 
-        files = [CONFIG["TODO_FILE"]]
-        if CONFIG["DONE_FILE"]:
+    files = [CONFIG["TODO_FILE"]]
+    with sync_batch():
+        edit_lines(dict([(n, None) for n in numbers]))
+        if CONFIG["DONE_DIR"]:
+            files.extend(archive_done(removed))
+        elif CONFIG["DONE_FILE"]:
             with open(CONFIG["DONE_FILE"], "a") as fd:
-                fd.write(removed)
+                fd.writelines(removed)
+                _sync(fd)
             files.append(CONFIG["DONE_FILE"])
 
-        print(removed[:-1])
-        print("TODO: Item {0} marked as done.".format(line))
-        if CONFIG["USE_GIT"]:
-            _git_commit(files, removed)
+    for (n, line) in zip(numbers, removed):
+        print(line[:-1])
+        print("TODO: Item {0} marked as done.".format(n))
+    if CONFIG["USE_GIT"]:
+        CONFIG["GIT"].add(files)
+        _git_commit(files, concat(removed))
 
 
-@usage('\tdel | rm NUMBER', '\t\tDeletes the item on line NUMBER in todo.txt',
-        '')
-def delete_todo(line):
-    """Delete an item without marking it as done."""
-    if not line.isdigit():
-        print("Usage: {0} (del|rm) item#".format(CONFIG["TODO_PY"]))
-    else:
-        removed, lines = separate_line(int(line))
-        if test_separated(removed, lines, line):
-            return
+@usage('\tdel | rm NUMBER [NUMBER ...]',
+    '\t\tDeletes the items on lines NUMBER in todo.txt', '')
+@locked(True)
+def delete_todo(args):
+    """Delete the items selected by args without marking them as done."""
+    if str(args) == args:
+        args = [args]
+    selected = select_todos(args)
+    if not selected:
+        if selected is None or not args:
+            print("Usage: {0} (del|rm) item#".format(CONFIG["TODO_PY"]))
+        return
 
-        with open(CONFIG["TODO_FILE"], "w") as fd:
-            rewrite_file(fd, lines)
+    numbers = sorted(selected)
+    edit_lines(dict([(n, None) for n in numbers]))
 
-        removed = "'{0}' deleted.".format(removed[:-1])
-        print(removed)
-        print("TODO: Item {0} deleted.".format(line))
-        if CONFIG["USE_GIT"]:
-            _git_commit([CONFIG["TODO_FILE"]], removed)
+    removed = []
+    for n in numbers:
+        removed.append("'{0}' deleted.".format(selected[n].text))
+        print(removed[-1])
+        print("TODO: Item {0} deleted.".format(n))
+    if CONFIG["USE_GIT"]:
+        _git_commit([CONFIG["TODO_FILE"]], concat(removed, "\n"))
 ### End do/del Functions
 
 
@@ -612,100 +2023,104 @@ def post_error(command, arg1, arg2):
 
 def post_success(item_no, old_line, new_line):
     """After changing a line, pring a standard line and commit the change."""
-    old_line = old_line.rstrip()
-    new_line = new_line.rstrip()
-    print_str = "TODO: Item {0} changed from '{1}' to '{2}'.".format(
-        item_no, old_line, new_line)
-    print(print_str)
-    if CONFIG["USE_GIT"]:
-        _git_commit([CONFIG["TODO_FILE"]], print_str)
+    post_many([(item_no, old_line, new_line)])
+
+
+def post_many(changes):
+    """Print the standard line for each (item_no, old_line, new_line) in
+    changes and commit them all at once."""
+    print_strs = []
+    for (item_no, old_line, new_line) in changes:
+        print_strs.append("TODO: Item {0} changed from '{1}' to '{2}'.".format(
+            item_no, old_line.rstrip(), new_line.rstrip()))
+        print(print_strs[-1])
+    if CONFIG["USE_GIT"] and print_strs:
+        _git_commit([CONFIG["TODO_FILE"]], concat(print_strs, "\n"))
+
+
+def edit_and_post(selected, change):
+    """Apply change() to each selected line (see select_todos()), write them
+    all with a single edit_lines() and post the result."""
+    if not selected:
+        return
+    changes = []
+    for n in sorted(selected):
+        changes.append((n, selected[n].text, change(selected[n])))
+    edit_lines(dict([(n, new) for (n, old, new) in changes]))
+    post_many(changes)
 
 
 @usage('\tappend | app NUMBER "text to append"',
     '\t\tAppend "text to append" to item NUMBER.\n')
+@locked(True)
 def append_todo(args):
     """Append text to the item specified."""
     if args[0].isdigit():
         line_no = int(args.pop(0))
-        old_line, lines = separate_line(line_no)
-        if test_separated(old_line, lines, line_no):
+        old_line = read_line(line_no)
+        if test_separated(old_line, line_no):
             return
 
-        new_line = concat([concat([old_line[:-1],
+        new_line = concat([concat([old_line.rstrip("\r\n"),
             concat(args, " ")], " "), "\n"])
-        lines.insert(line_no - 1, new_line)
 
-        rewrite_and_post(line_no, old_line, new_line, lines)
+        rewrite_and_post(line_no, old_line, new_line)
     else:
         post_error('append', 'NUMBER', 'string')
 
 
-@usage('\tpri | p NUMBER [A-X]',
-    '\t\tAdd priority specified (A, B, C, etc.) to item NUMBER.\n')
+@usage('\tpri | p NUMBER [NUMBER ...] [A-X]',
+    '\t\tAdd priority specified (A, B, C, etc.) to items NUMBER.\n')
+@locked(True)
 def prioritize_todo(args):
-    """Add or modify the priority of the specified item."""
-    args = [arg.upper() for arg in args]
-    if args[1:] and args[0].isdigit()\
-            and len(args[1]) == 1 and args[1] in PRIORITIES:
-        line_no = int(args.pop(0))
-        old_line, lines = separate_line(line_no)
-        if test_separated(old_line, lines, line_no):
-            return
-
-        new_pri = concat(["(", args[0], ") "])
-        r = re.match("(\([A-X]\)\s).*", old_line)
-        if r:
-            new_line = re.sub(re.escape(r.groups()[0]), new_pri, old_line)
-        else:
-            new_line = concat([new_pri, old_line])
-
-        lines.insert(line_no - 1, new_line)
-        rewrite_and_post(line_no, old_line, new_line, lines)
-    else:
+    """Add or modify the priority of the specified items."""
+    selected = None
+    if args[1:] and len(args[-1]) == 1 and args[-1].upper() in PRIORITIES:
+        selected = select_todos(args[:-1])
+    if selected is None:
         post_error('pri', 'NUMBER', 'capital letter in [A-X]')
+        return
 
+    new_pri = concat(["(", args[-1].upper(), ") "])
+    edit_and_post(selected, lambda t: concat([new_pri, t.body, "\n"]))
 
-@usage('\tdepri | dp NUMBER',
-    '\t\tRemove the priority of the item on line NUMBER.\n')
-def de_prioritize_todo(number):
-    """Remove priority markings from the beginning of the line if they're
+
+@usage('\tdepri | dp NUMBER [NUMBER ...]',
+    '\t\tRemove the priority of the items on lines NUMBER.\n')
+@locked(True)
+def de_prioritize_todo(args):
+    """Remove priority markings from the beginning of the lines if they're
     there. Don't complain otherwise."""
-    if number.isdigit():
-        number = int(number)
-        old_line, lines = separate_line(number)
-        if test_separated(old_line, lines, number):
-            return
+    if str(args) == args:
+        args = [args]
+    selected = select_todos(args)
+    if selected is None or not args:
+        post_error('depri', 'NUMBER', None)
+        return
 
-        new_line = re.sub("(\([A-X]\)\s)", "", old_line)
-        lines.insert(number - 1, new_line)
-
-        rewrite_and_post(number, old_line, new_line, lines)
-    else:
-        post_err('depri', 'NUMBER', None)
+    edit_and_post(selected, lambda t: concat([t.body, "\n"]))
 
 
 @usage('\tprepend | pre NUMBER "text to prepend"',
     '\t\tAdd "text to prepend" to the beginning of the item.\n')
+@locked(True)
 def prepend_todo(args):
     """Take in the line number and prepend the rest of the arguments to the
     item specified by the line number."""
     if args[0].isdigit():
         line_no = int(args.pop(0))
         prepend_str = concat(args, " ") + " "
-        old_line, lines = separate_line(line_no)
-        if test_separated(old_line, lines, line_no):
+        old_line = read_line(line_no)
+        if test_separated(old_line, line_no):
             return
 
-        pri_re = re.compile('^(\([A-X]\)\s)')
-
-        if pri_re.match(old_line):
-            new_line = pri_re.sub(concat(["\g<1>", prepend_str]), old_line)
+        task = Task(line_no, old_line)
+        if task.priority and not task.done:
+            new_line = concat([old_line[:4], prepend_str, old_line[4:]])
         else:
             new_line = concat([prepend_str, old_line])
 
-        lines.insert(line_no - 1, new_line)
-
-        rewrite_and_post(line_no, old_line, new_line, lines)
+        rewrite_and_post(line_no, old_line, new_line)
     else:
         post_error('prepend', 'NUMBER', 'string')
 ### End Post-production todo functions
@@ -729,40 +2144,131 @@ def cmd_help():
 
 
 ### List Printing Functions
-def format_lines(color_only=False, include_done=False):
-    """Take in a list of lines to do, return them formatted with the
-    TERM_COLORS and organized based upon priority."""
-    plain = CONFIG["PLAIN"]
+def _category(task):
+    """Return the priority task is listed under, "X" if it has none."""
+    if task.priority and task.priority != "X" and not task.done:
+        return task.priority
+    return "X"
+
+
+_format_token_re = re.compile('\{(\w+)\}')
+_DEFAULT_FORMAT = "{num} {pri} {text}"
+
+
+def _compile_format(template=None):
+    """Compile the TODOTXT_FORMAT line template into a render(task, pad)
+    function. These {tokens} are replaced:
+
+        {num}       the line number, zero padded to pad digits
+        {pri}       the priority, e.g. (A); empty with -P
+        {text}      the item without its priority
+        {created}   the creation date
+        {due}       the first #{yyyy-mm-dd} date
+        {projects}  the +projects
+        {contexts}  the @contexts
+
+    A token that renders empty takes the space after it with it. The
+    +projects, @contexts and #{dates} hidden with -+, -@ and -# are dropped
+    from {text} by the words the Task was parsed into, so only lines having
+    them are changed. Raises ValueError for an unknown token. The renderer
+    for each template and set of options is only compiled once."""
+    template = template or CONFIG["TODOTXT_FORMAT"] or _DEFAULT_FORMAT
+    hide_proj, hide_cont, hide_date = (CONFIG["HIDE_PROJ"],
+            CONFIG["HIDE_CONT"], CONFIG["HIDE_DATE"])
     no_priority = CONFIG["NO_PRI"]
+    key = (template, hide_proj, hide_cont, hide_date, no_priority)
+    if key in _renderers:
+        return _renderers[key]
+
+    def pri(task, pad):
+        if not task.priority or task.done:
+            return ""
+        if no_priority and task.priority != "X":
+            return ""
+        return concat(["(", task.priority, ")"])
+
+    def text(task, pad):
+        body = task.body
+        hidden = set()
+        if hide_proj:
+            hidden.update(["+" + p for p in task.projects])
+        if hide_cont:
+            hidden.update(["@" + c for c in task.contexts])
+        dated = hide_date and task.dates
+        if not (hidden or dated):
+            return body
+        return " ".join([w for w in body.split(" ") if w not in hidden and
+            not (dated and w[:2] == "#{" and w[-1:] == "}")])
+
+    tokens = {
+            "num": lambda task, pad: str(task.number).zfill(pad),
+            "pri": pri,
+            "text": text,
+            "created": lambda task, pad: task.created or "",
+            "due": lambda task, pad: min(task.dates).isoformat() \
+                    if task.dates else "",
+            "projects": lambda task, pad: " ".join(
+                ["+" + p for p in task.projects]),
+            "contexts": lambda task, pad: " ".join(
+                ["@" + c for c in task.contexts]),
+            }
+
+    parts = _format_token_re.split(template)
+    head = parts[0]
+    pieces = []
+    for (name, literal) in zip(parts[1::2], parts[2::2]):
+        if name not in tokens:
+            raise ValueError(concat(["unknown token in TODOTXT_FORMAT: {",
+                name, "}"]))
+        pieces.append((tokens[name], literal, literal[1:]))
+
+    def render(task, pad):
+        out = [head]
+        for (token, literal, trimmed) in pieces:
+            value = token(task, pad)
+            out.append(value)
+            out.append(literal if value or literal[:1] != " " else trimmed)
+        return "".join(out)
+
+    _renderers[key] = render
+    return render
+
+
+def _format_tasks(tasks, pad):
+    """Color each Task by its priority and render it with the TODOTXT_FORMAT
+    template. Yields (category, task, line) tuples where category is the
+    priority the line is listed under."""
+    plain = CONFIG["PLAIN"]
+    render = _compile_format()
     default = CONFIG.get("DEFAULT", "default")
     default = TERM_COLORS[default] if not plain else ""
     invert = TERM_COLORS["reverse"] if CONFIG["INVERT"] else ""
-    pri_re = re.compile('^\(([A-W])\)\s')
-    category = ""
-    pad = todo_padding(include_done)
     colors = set(TERM_COLORS.keys())  # Supposedly sets are faster for look-ups
 
-    formatted = []
-    if not color_only:
-        formatted = dict(zip(PRIORITIES, [[] for i in PRIORITIES]))
-
-    for (i, line) in enumerate(iter_todos(include_done)):
-        category = "X"
+    for task in tasks:
+        category = _category(task)
         color = default
 
-        r = pri_re.match(line)
-        if r:
-            category = r.groups()[0]
+        if category != "X":
             color_name = CONFIG["PRI_{0}".format(category)]
 
             if not plain and color_name in colors:
                 color = TERM_COLORS[color_name]
-            if no_priority:
-                line = pri_re.sub("", line)
 
-        i = str(i + 1).zfill(pad)
-        l = concat([color, invert, i, " ", line[:-1], default, "\n"])
+        yield (category, task,
+                concat([color, invert, render(task, pad), default, "\n"]))
+
+
+def format_lines(color_only=False, include_done=False):
+    """Take in a list of lines to do, return them formatted with the
+    TERM_COLORS and organized based upon priority."""
+    pad = todo_padding(include_done)
+
+    formatted = []
+    if not color_only:
+        formatted = dict(zip(PRIORITIES, [[] for i in PRIORITIES]))
 
+    for (category, task, l) in _format_tasks(iter_tasks(include_done), pad):
         if color_only:
             formatted.append(l)
         else:
@@ -771,71 +2277,439 @@ def format_lines(color_only=False, include_done=False):
     return formatted
 
 
-def _legacy_sort(items):
-    """Sort items alphabetically, i.e.
-
-    # (pri_a) Abc
-    # (pri_a) Bcd
-    # (pri_b) Abc
-    # (pri_c) Bcd
-    etc., etc., etc."""
-    line_re = re.compile('^.*\d+\s(\([A-X]\)\s)?')
-    # The .* in the regexp is needed for the \033[* codes
-    items = sorted([(line_re.sub("", i), i) for i in items])
-    items = [line for (k, line) in items]
-    return items
-
-
-def _list_(by, regexp):
-    """Master list_*() function."""
-    nonetype = concat(["no", by])
-    todo = {nonetype: []}
-    by_list = []
-    sorted = []
-
-    if by in ["date", "project", "context"]:
-        lines = format_lines(color_only=True)
-        regexp = re.compile(regexp)
-        for line in lines:
-            match = regexp.findall(line)
+def _first(values):
+    """Sort key part for a list of tags: the lowest, with untagged items
+    sorted last."""
+    if not values:
+        return (1, "")
+    return (0, min([v.lower() for v in values]))
+
+
+# The --sort keys: each maps a Task to a value to order it by, built from
+# the parsed fields so colors and the TODOTXT_FORMAT don't matter. Values
+# must be marshal-able for _write_merged().
+SORT_KEYS = {
+        "pri": lambda task: _PRIORITY_RANK[_category(task)],
+        "created": lambda task: (task.created is None, task.created or ""),
+        "due": lambda task: (not task.dates,
+            min(task.dates).toordinal() if task.dates else 0),
+        "project": lambda task: _first(task.projects),
+        "context": lambda task: _first(task.contexts),
+        "text": lambda task: task.body,
+        "num": lambda task: task.number,
+        }
+
+
+def _sort_key(spec=None):
+    """Compile a comma separated list of SORT_KEYS, by default SORT (or
+    "pri,text" with LEGACY), into a function returning a Task's sort key.
+    Ties keep the todo.txt order since the sorts used are stable.
+
+    Returns None for the default order, priority then line number, which
+    the list functions produce without sorting. Raises ValueError for an
+    unknown key."""
+    if spec is None:
+        spec = CONFIG["SORT"] or ("pri,text" if CONFIG["LEGACY"] else "")
+    names = [n.strip() for n in spec.lower().split(",") if n.strip()]
+    for name in names:
+        if name not in SORT_KEYS:
+            raise ValueError(concat(["unknown sort key: ", name]))
+    if names in ([], ["pri"], ["pri", "num"]):
+        return None
+    keys = [SORT_KEYS[n] for n in names]
+    if len(keys) == 1:
+        return keys[0]
+    return lambda task: tuple([k(task) for k in keys])
+
+
+def _spill(items):
+    """Write the marshal-able items to a temporary file and rewind it."""
+    fd = TemporaryFile()
+    for item in items:
+        marshal.dump(item, fd)
+    fd.seek(0)
+    return fd
+
+
+def _iter_spilled(fd):
+    """Yield the items _spill() wrote to fd, closing it at the end."""
+    try:
+        while True:
+            try:
+                yield marshal.load(fd)
+            except EOFError:
+                break
+    finally:
+        fd.close()
+
+
+# The most spilled runs _bounded_sort() merges at once, each an open file.
+_MERGE_FAN_IN = 64
+
+
+def _bounded_sort(items, limit):
+    """Sort items (marshal-able tuples) with at most limit of them in memory.
+    Each time limit items have been collected they are sorted and spilled to
+    a temporary file; the sorted runs are then merged with a k-way heap merge.
+    While there are more than _MERGE_FAN_IN runs they are merged that many
+    at a time into longer runs first, so no more files are open at once.
+
+    All of items is consumed before this returns an iterator over the sorted
+    items."""
+    runs = []
+    buf = []
+    for item in items:
+        buf.append(item)
+        if len(buf) >= limit:
+            buf.sort()
+            runs.append(_spill(buf))
+            buf = []
+    buf.sort()
+    if not runs:
+        return iter(buf)
+    runs.append(_spill(buf))
+    del(buf)
+    while len(runs) > _MERGE_FAN_IN:
+        runs = [_spill(heapq.merge(*[_iter_spilled(fd) for fd in
+            runs[i:i + _MERGE_FAN_IN]]))
+            for i in range(0, len(runs), _MERGE_FAN_IN)]
+    return heapq.merge(*[_iter_spilled(fd) for fd in runs])
+
+
+def _write_merged(tasks, match, limit, total=None, offset=0):
+    """_write_listing() for when MAX_LINES is set: instead of grouping Tasks
+    in memory they are ordered with _bounded_sort() by their sort key and
+    line number. The first offset of them are skipped."""
+    key = _sort_key() or SORT_KEYS["pri"]
+    count = [0]
+
+    def keyed():
+        for task in tasks:
+            count[0] += 1
+            if match is None or match(task):
+                yield (key(task), task.number, task.record())
+
+    merged = _bounded_sort(keyed(), limit)
+    if total is None:
+        total = count[0]
+    ordered = (Task.from_record(n, r) for (_, n, r) in islice(merged, offset,
+        None))
+    shown = write_lines(line for (_, _, line) in
+            _format_tasks(ordered, _padding(total)))
+    return (shown, total)
+
+
+def _write_top(tasks, match, limit, offset, total=None):
+    """_write_listing() for when LIMIT is set: only the items at positions
+    offset to offset + limit of the listing are written. At most that many
+    Tasks are kept, in a heap, and no others are rendered.
+
+    In the default order, by priority and line number, once the heap is full
+    of top priority items no later item can displace one and the rest are
+    only counted."""
+    key = _sort_key()
+    tasks = iter(tasks)
+    size = offset + limit
+    count = [0]
+
+    def matching():
+        for task in tasks:
+            count[0] += 1
+            if match is None or match(task):
+                yield task
+
+    if key is not None:
+        top = heapq.nsmallest(size, ((key(t), t.number, t)
+            for t in matching()))
+    else:
+        # A max-heap of the items kept: heap[0] is the last one listed.
+        heap = []
+        for task in matching():
+            key = (-_PRIORITY_RANK[_category(task)], -task.number, task)
+            if len(heap) < size:
+                heapq.heappush(heap, key)
+            elif key > heap[0]:
+                heapq.heapreplace(heap, key)
+            if len(heap) == size and heap[0][0] == 0:
+                break
+        top = sorted(heap, reverse=True)
+    if total is None:
+        total = count[0] + sum(1 for _ in tasks)
+
+    top = [key[-1] for key in top][offset:]
+    write_lines(line for (_, _, line) in _format_tasks(top, _padding(total)))
+    return (len(top), total)
+
+
+def _write_listing(tasks, match=None, total=None):
+    """The list pipeline: tasks are read and parsed as they're iterated,
+    filtered with match(task), grouped by priority, then rendered and written
+    to stdout one line at a time. Only the matching Tasks are kept in memory
+    and the todo files are read once. Returns (shown, total).
+
+    total -- the number of items listed when tasks is only a pre-selected
+    part of them; by default the tasks are counted.
+
+    The first OFFSET items are skipped. With LIMIT set only that many items
+    after them are listed; see _write_top(). With MAX_LINES set no more
+    than that many Tasks are held at once; see _write_merged()."""
+    offset = int(CONFIG["OFFSET"])
+    if int(CONFIG["LIMIT"]) > 0:
+        return _write_top(tasks, match, int(CONFIG["LIMIT"]), offset, total)
+    if int(CONFIG["MAX_LINES"]) > 0:
+        return _write_merged(tasks, match, int(CONFIG["MAX_LINES"]), total,
+                offset)
+    key = _sort_key()
+    groups = dict([(p, []) for p in PRIORITIES])
+    count = 0
+    for task in tasks:
+        count += 1
+        if match is None or match(task):
+            groups[_category(task)].append(task)
+
+    if total is None:
+        total = count
+    ordered = [groups.pop(p) for p in PRIORITIES]
+    if key is not None:
+        # One stable decorate-sort pass over all of the matching Tasks.
+        ordered = [sorted([t for group in ordered for t in group], key=key)]
+    ordered = islice((t for group in ordered for t in group), offset, None)
+    shown = write_lines(line for (_, _, line) in
+            _format_tasks(ordered, _padding(total)))
+    return (shown, total)
+
+
+# The list_*() groupings: each maps a Task to the keys of the groups it's
+# listed under. Add an entry to group on other metadata.
+GROUP_KEYS = {
+        "date": lambda task: task.dates,
+        "project": lambda task: task.projects,
+        "context": lambda task: task.contexts,
+        "created": lambda task: [task.created] if task.created else [],
+        }
+
+
+def _list_(by, regexp=None, only=None, window=None, undone=False):
+    """Master list_*() function.
+
+    Tasks are grouped under the keys GROUP_KEYS[by] returns for them, with a
+    dict from each key to its lines; the keys are sorted once at the end.
+    With --sort the Tasks are sorted before they're grouped. regexp is
+    accepted for backwards compatibility and ignored.
+
+    only -- a list of keys; when given only their groups are listed and,
+    for projects and contexts with TAG_INDEX set, only their lines are
+    read.
+
+    window -- for dates, a (since, until) pair of dates or Nones; only the
+    dates in it are listed, and only the lines date_index() has for it are
+    read.
+
+    undone -- if True the items marked done (x) are left out."""
+    groups = {}
+    ungrouped = []
+    sorted_ = []
+    key = _sort_key()
+    tasks = iter_tasks()
+
+    if by in GROUP_KEYS:
+        lines = []
+        keys = GROUP_KEYS[by]
+        if only:
+            sigil = {"project": "+", "context": "@"}.get(by, "")
+            only = set([o.lstrip(sigil) for o in only])
+            index = tag_index() if sigil else None
+            if index is not None:
+                numbers = set()
+                for o in only:
+                    numbers.update(index.get(concat([sigil, o]), []))
+                tasks = read_tasks(numbers)
+        if window and by == "date":
+            (since, until) = window
+            tasks = read_tasks(dated_lines(date_index(), since, until))
+        if undone:
+            tasks = (task for task in tasks if not task.done)
+        if key is not None:
+            tasks = sorted(tasks, key=key)
+        for (_, task, line) in _format_tasks(tasks, todo_padding()):
+            match = keys(task)
+            if only:
+                match = [i for i in match if str(i) in only]
+            if window and by == "date":
+                match = [i for i in match if (since is None or since <= i) and
+                        (until is None or i <= until)]
+            if only or window:
+                if not match:
+                    continue
+            lines.append(line)
             if match:
                 line = concat(["\t", line])
                 for i in match:
-                    if by == "date":
-                        i = date(int(i[0]), int(i[1]), int(i[2]))
-                    if i not in by_list:
-                        by_list.append(i)
-                        todo[i] = [line]
-                    else:
-                        todo[i].append(line)
+                    groups.setdefault(i, []).append(line)
             else:
-                todo[nonetype].append(line)
+                ungrouped.append(line)
     elif by == "pri":
-        lines = format_lines()
-        todo.update(lines)
-        by_list = list(PRIORITIES)
-
-    by_list.sort()
-
-    regstr = '(\+\w+\s?)' if CONFIG["HIDE_PROJ"] else ''
-    hide_proj_re = re.compile(regstr)
-    regstr = '(@\w+\s?)' if CONFIG["HIDE_CONT"] else ''
-    hide_cont_re = re.compile(regstr)
-    regstr = '(#\{\d+-\d+-\d+\}\s?)' if CONFIG["HIDE_DATE"] else ''
-    hide_date_re = re.compile(regstr)
-
-    for b in by_list:
-        todo[b] = [hide_proj_re.sub("", l) for l in todo[b]]
-        todo[b] = [hide_cont_re.sub("", l) for l in todo[b]]
-        todo[b] = [hide_date_re.sub("", l) for l in todo[b]]
-        if CONFIG["LEGACY"]:
-            todo[b] = _legacy_sort(todo[b])
+        lines = dict([(p, []) for p in PRIORITIES])
+        if key is not None:
+            tasks = sorted(tasks, key=key)
+        for (category, _, line) in _format_tasks(tasks, todo_padding()):
+            lines[category].append(line)
+        groups = dict([(p, l) for (p, l) in lines.items() if l])
+    else:
+        raise KeyError(by)
+
+    for b in sorted(groups):
+        group = groups[b]
         if by != "pri":
-            sorted.append(concat([b, ":\n"]))
-        sorted.extend(todo[b])
+            sorted_.append(concat([b, ":\n"]))
+        sorted_.extend(group)
+
+    sorted_.extend(ungrouped)
+    return (lines, sorted_)
+
+
+def term_matcher(terms):
+    """Return a predicate that is True for the Tasks whose text contains
+    every one of terms, ignoring case, or None if there are no terms.
+
+    Each line is lowered once and the terms are looked for longest (and so
+    most likely to be missing) first; the first one that's missing ends the
+    check for that line."""
+    terms = sorted(set([t.lower() for t in terms if t]), key=len,
+            reverse=True)
+    if not terms:
+        return None
+
+    def match(task):
+        text = task.text.lower()
+        for term in terms:
+            if term not in text:
+                return False
+        return True
+    return match
+
+
+_tag_word_re = re.compile('^[+@]\w+$')
+_query_re = re.compile('^(pri|created|due):?(<=|>=|<|>|=|:)(.+)$')
+_pri_range_re = re.compile('^([A-Xa-x])(?:-([A-Xa-x]))?$')
+_query_days = {"yesterday": -1, "today": 0, "tomorrow": 1}
+
 
-    sorted.extend(todo[nonetype])
-    return (lines, sorted)
+def _query_date(value):
+    """Parse the yyyy-mm-dd, today, yesterday or tomorrow of a query term
+    into a date."""
+    if value.lower() in _query_days:
+        return date.fromordinal(date.today().toordinal() +
+                _query_days[value.lower()])
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+_query_ops = {
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "=": lambda a, b: a == b,
+        ":": lambda a, b: a == b,
+        }
+
+
+def _query_term(key, op, value):
+    """Compile one key/op/value term of a query into a predicate."""
+    if key == "pri":
+        m = _pri_range_re.match(value)
+        if not m or op != ":":
+            raise ValueError(concat(["bad priority term: pri", op, value]))
+        low = m.group(1).upper()
+        high = (m.group(2) or low).upper()
+        return lambda t: t.priority is not None and low <= t.priority <= high
+
+    try:
+        when = _query_date(value)
+    except ValueError:
+        raise ValueError(concat(["bad date in: ", key, op, value]))
+    test = _query_ops[op]
+    if key == "created":
+        when = when.isoformat()
+        return lambda t: t.created is not None and test(t.created, when)
+    # An item is due on the earliest of its #{yyyy-mm-dd} dates.
+    return lambda t: bool(t.dates) and test(min(t.dates), when)
+
+
+def compile_query(terms):
+    """Compile a list filter into (predicate, tags), or (None, []) if there
+    is nothing to filter by. A ValueError is raised for a malformed term.
+
+    Each of terms is one term, as given on the command line, and all of
+    them must hold for a Task to match. A query given as a single argument
+    is split into its words if any of them is a pri:, created or due term or
+    a -TERM, as in 'pri:A-C +work -@home'; otherwise it's one term, like
+    "buy milk".
+
+        pri:A or pri:A-C    the priority is (in) the given range
+        created>DATE        the item was created before/after DATE, with
+        due<DATE            < <= > >= or =; an item is due on the first of
+                            its #{yyyy-mm-dd} dates. DATE is yyyy-mm-dd,
+                            today, yesterday or tomorrow
+        -TERM               the negation of any other term
+        TERM                the text contains TERM, ignoring case; this
+                            includes +project and @context words, phrases
+                            like "buy milk" and key:value words that
+                            aren't a pri: or date term, like pri:foo
+
+    tags are the +project and @context words that must be present, which
+    the caller can look up in tag_index() to only read the lines having
+    them. Only words that are a whole tag, like +work but not +work-items,
+    are tags, since the index finds lines by the start of their tags. The
+    predicate is built once so each Task is checked in one pass, cheapest
+    checks first."""
+    if len(terms) == 1 and [w for w in terms[0].split() if
+            (w[:1] == "-" and len(w) > 1) or _query_re.match(w.lower())]:
+        terms = terms[0].split()
+
+    plain, negated, tests, tags = [], [], [], []
+    for word in terms:
+        negate = word[:1] == "-" and len(word) > 1
+        if negate:
+            word = word[1:]
+        m = _query_re.match(word.lower())
+        test = None
+        if m:
+            try:
+                test = _query_term(*m.groups())
+            except ValueError:
+                # A comparison is always meant as one, but key:value may
+                # just as well be text.
+                if m.group(2) != ":":
+                    raise
+        if test is not None:
+            if negate:
+                test = (lambda f: lambda t: not f(t))(test)
+            tests.append(test)
+        elif negate:
+            negated.append(word.lower())
+        else:
+            plain.append(word)
+            if _tag_word_re.match(word):
+                tags.append(word)
+
+    contains = term_matcher(plain)
+    if not (contains or negated or tests):
+        return (None, [])
+
+    def match(task):
+        if negated:
+            text = task.text.lower()
+            for word in negated:
+                if word in text:
+                    return False
+        if contains is not None and not contains(task):
+            return False
+        for test in tests:
+            if not test(task):
+                return False
+        return True
+    return (match, tags)
 
 
 def _list_by_(*args):
@@ -843,84 +2717,396 @@ def _list_by_(*args):
     Print lines matching items in args
     Called when the user does:
         todo.py ls search-term1 search-term2 ...
-    """
-    esc = re.escape  # keep line length down
-    relist = [re.compile(concat(["\s?(", esc(a), ")\s?"]), re.I) for a in args]
-    del(esc)  # don't need it anymore
-
-    alines = format_lines()  # Retrieves all lines.
-    lines = []
-    for p in PRIORITIES:
-        lines.extend(alines[p])
-
-    alines = lines[:]
-    matched_lines = []
-
-    for regexp in relist:
-        matched_lines = [line for line in lines if regexp.search(line)]
-        lines = matched_lines[:]
-
-    if lines:
-        print(concat(lines)[:-1])
-    print_x_of_y(lines, alines)
 
+    args is a query; see compile_query().
+    """
+    try:
+        match, tags = compile_query(args)
+    except ValueError as e:
+        print(concat(["TODO: ", str(e)]))
+        return
 
-@usage('\tlist | ls',
-    '\t\tLists all items in your todo.txt file sorted by priority.\n')
+    tasks = iter_tasks()
+    total = None
+    index = tag_index() if tags else None
+    if index is not None:
+        # Only the lines having the tags need to be read and checked.
+        numbers = tagged_lines(index, tags[0])
+        for tag in tags[1:]:
+            numbers.intersection_update(tagged_lines(index, tag))
+        tasks = read_tasks(numbers)
+        total = count_todos()
+
+    shown, total = _write_listing(tasks, match, total)
+    print_x_of_y(shown, total)
+
+
+@usage('\tlist | ls [QUERY ...]',
+    '\t\tLists all items in your todo.txt file sorted by priority. A QUERY',
+    '\t\tlike \'pri:A-C +work -@home created>2012-01-01 due<today\' lists',
+    '\t\tonly the items matching all of its terms. Given as several',
+    '\t\targuments each is one term, so ls "buy milk" @shop finds the',
+    '\t\tphrase. With --dirs the items of several directories are listed',
+    '\t\ttogether, each line starting with the directory to give -d to',
+    '\t\tchange it.\n')
+@locked(False)
 def list_todo(args=None, plain=False, no_priority=False):
     """Print the list of todo items in order of priority and position in the
     todo.txt file."""
-    if not args:
-        lines, sorted = _list_("pri", "")
-        print(concat(sorted)[:-1])
-        print_x_of_y(sorted, sorted)
+    if CONFIG["TODO_DIRS"]:
+        list_dirs(args or [])
+    elif not args:
+        shown, total = _write_listing(iter_tasks())
+        print_x_of_y(shown, total)
     else:
         _list_by_(*args)
 
 
+@usage('\tnext [N] [QUERY ...]',
+    '\t\tLists the N (by default 1) most important items in your todo.txt',
+    '\t\tfile, or in those matching QUERY.\n')
+@locked(False)
+def next_todo(args):
+    """Print the items at the top of list_todo() without listing the rest."""
+    CONFIG["LIMIT"] = 1
+    if args and args[0].isdigit():
+        CONFIG["LIMIT"] = max(int(args[0]), 1)
+        args = args[1:]
+    list_todo(args)
+
+
 @usage('\tlistall | lsa',
     '\t\tLists all items in your todo.txt file sorted by priority followed',
-    '\t\tby the items in your done.txt file.\n')
+    '\t\tby the items in your done.txt file. Use --from and --to to only',
+    '\t\tlist the items completed between two dates.\n')
+@locked(False)
 def list_all():
     """Print the list of todo items in order of priority and then print the
     done.txt file."""
-    formatted = format_lines(include_done=True)
-    lines = []
-    for p in PRIORITIES:
-        lines.extend(formatted[p])
-    if lines:
-        print(concat(lines)[:-1])
-    print_x_of_y(lines, lines)
+    shown, total = _write_listing(iter_tasks(include_done=True))
+    print_x_of_y(shown, total)
 
 
 @usage('\tlistdate | lsd',
-    '\t\tLists all items in your todo.txt file sorted by date.\n')
+    '\t\tLists all items in your todo.txt file sorted by date. Use --from',
+    '\t\tand --to to only list the dates between them, or --overdue for',
+    '\t\tthe undone items with dates before today.\n')
+@locked(False)
 def list_date():
     """List todo items by date #{yyyy-mm-dd}."""
-    lines, sorted = _list_("date", "#\{(\d{4})-(\d{1,2})-(\d{1,2})\}")
-    print(concat(sorted)[:-1])
+    window = None
+    try:
+        if CONFIG["OVERDUE"]:
+            window = (None, _query_date("yesterday"))
+        elif CONFIG["DATE_FROM"] or CONFIG["DATE_TO"]:
+            window = [_query_date(CONFIG[d]) if CONFIG[d] else None
+                    for d in ("DATE_FROM", "DATE_TO")]
+    except ValueError:
+        print("TODO: --from and --to take dates like 2012-01-31.")
+        return
+    lines, sorted = _list_("date", window=window, undone=CONFIG["OVERDUE"])
+    write_lines(sorted)
     print_x_of_y(sorted, lines)
 
 
-@usage('\tlistproj | lsp',
-    '\t\tLists all items in your todo.txt file sorted by project title.\n')
-def list_project():
+@usage('\tlistby | lsb KEY [VALUE ...]',
+    '\t\tLists all items in your todo.txt file grouped by KEY, one of',
+    '\t\tcontext, created, date or project, or only the items of the given',
+    '\t\tVALUEs.\n')
+@locked(False)
+def list_by(args):
+    """Organizes items by any of the GROUP_KEYS."""
+    if not args or args[0] not in GROUP_KEYS:
+        print("Usage: {0} (listby|lsb) ({1}) [VALUE ...]".format(
+            CONFIG["TODO_PY"], concat(sorted(GROUP_KEYS), "|")))
+        return
+    lines, sorted_ = _list_(args[0], only=args[1:])
+    write_lines(sorted_)
+    print_x_of_y(sorted_, lines)
+
+
+@usage('\tlistproj | lsp [PROJECT ...]',
+    '\t\tLists all items in your todo.txt file sorted by project title,',
+    '\t\tor only the items of the given projects.\n')
+@locked(False)
+def list_project(args=None):
     """Organizes items by project +prj they belong to."""
-    lines, sorted = _list_("project", "\+(\w+)")
-    print(concat(sorted)[:-1])
+    lines, sorted = _list_("project", only=args)
+    write_lines(sorted)
     print_x_of_y(sorted, lines)
 
 
-@usage('\tlistcon | lsc',
-    '\t\tLists all items in your todo.txt file sorted by context.\n')
-def list_context():
+@usage('\tlistcon | lsc [CONTEXT ...]',
+    '\t\tLists all items in your todo.txt file sorted by context, or only',
+    '\t\tthe items in the given contexts.\n')
+@locked(False)
+def list_context(args=None):
     """Organizes items by context @context associated with them."""
-    lines, sorted = _list_("context", "@(\w+)")
-    print(concat(sorted)[:-1])
+    lines, sorted = _list_("context", only=args)
+    write_lines(sorted)
     print_x_of_y(sorted, lines)
 ### End LP Functions
 
 
+### Search Functions
+# The search index is a {trigram: sorted line numbers} marshal sidecar for
+# todo.txt, patched by _sync_sidecars(), and SEARCH_INDEX.done for the done
+# items. The done files are only ever appended to, so the done index keeps the
+# size each was indexed up to and reads only what was added since.
+def _trigrams(text):
+    """Return the set of three character pieces of each word of text, lowered
+    and padded with spaces so short words and word starts count too."""
+    grams = set()
+    for word in text.lower().split():
+        word = concat(["  ", word, " "])
+        for i in range(len(word) - 2):
+            grams.add(word[i:i + 3])
+    return grams
+
+
+def search_index():
+    """Return {trigram: sorted line numbers} for todo.txt. With SEARCH_INDEX
+    set it's kept in that file and rebuilt when stale; otherwise it's built
+    each time."""
+    stamp = _todo_stamp()
+    if stamp is None:
+        return {}
+    grams = None
+    if CONFIG["SEARCH_INDEX"]:
+        grams = _load_marshal(CONFIG["SEARCH_INDEX"], _SEARCH_VERSION, stamp)
+    if grams is None:
+        grams = {}
+        _patch_postings(grams, 1,
+                [(t.number, _trigrams(t.text)) for t in iter_tasks()])
+        if CONFIG["SEARCH_INDEX"]:
+            _write_marshal(CONFIG["SEARCH_INDEX"], _SEARCH_VERSION, stamp,
+                    grams)
+    return grams
+
+
+def done_search_index():
+    """Return (entries, grams) for the done items: entries is the list of
+    (path, byte offset) of every done item and grams maps each trigram to
+    the positions in entries of the items having it. Items appended to the
+    done files since the index was saved are added to it; if a file was
+    rewritten (see archive) the index is rebuilt."""
+    path = concat([CONFIG["SEARCH_INDEX"], ".done"])
+    index = None
+    if CONFIG["SEARCH_INDEX"]:
+        index = _load_marshal(path, _SEARCH_VERSION, ())
+    (sizes, entries, grams) = index or ({}, [], {})
+    files = [f for f in _done_files() if os.path.isfile(f)]
+    for f in sizes:
+        stamp = _file_stamp(f)
+        if f not in files or stamp[0] < sizes[f][0] or \
+                stamp[2] != sizes[f][1]:
+            (sizes, entries, grams) = ({}, [], {})
+            break
+
+    changed = False
+    for f in files:
+        stamp = _file_stamp(f)
+        (offset, _) = sizes.get(f, (0, stamp[2]))
+        if stamp[0] == offset:
+            continue
+        with open(f, "rb") as fd:
+            fd.seek(offset)
+            for line in fd:
+                for gram in _trigrams(line.decode(ENCODING)):
+                    grams.setdefault(gram, []).append(len(entries))
+                entries.append((f, offset))
+                offset += len(line)
+        sizes[f] = (offset, stamp[2])
+        changed = True
+    if changed and CONFIG["SEARCH_INDEX"]:
+        _write_marshal(path, _SEARCH_VERSION, (), (sizes, entries, grams))
+    return (entries, grams)
+
+
+def _ranked(grams, postings, limit, text_of):
+    """Yield (score, key, text) for the best limit keys of postings sharing
+    at least a third of the query's grams, by the Jaccard similarity of
+    their trigrams and the query's. text_of(keys) yields (key, text)."""
+    hits = {}
+    for gram in grams:
+        for key in postings.get(gram, ()):
+            hits[key] = hits.get(key, 0) + 1
+    wanted = max(1, len(grams) // 3)
+    candidates = [k for (k, n) in hits.items() if n >= wanted]
+    scored = []
+    for (key, text) in text_of(candidates):
+        common = hits[key]
+        score = common / float(len(grams) + len(_trigrams(text)) - common)
+        scored.append((score, key, text))
+    return heapq.nlargest(limit, scored, key=lambda s: (s[0], -s[1]))
+
+
+@usage('\tsearch QUERY',
+    '\t\tLists the items in your todo.txt and done.txt files most like',
+    '\t\tQUERY, best first, even when the words are misspelt. Set',
+    '\t\tSEARCH_INDEX to keep the index used between runs. Use --limit to',
+    '\t\tchange how many are listed (by default 10).\n')
+@locked(False)
+def search_todo(args):
+    """Print the items ranked by their trigram similarity to args."""
+    grams = _trigrams(concat(args, " "))
+    if not grams:
+        print("Usage: {0} search QUERY".format(CONFIG["TODO_PY"]))
+        return
+    limit = int(CONFIG["LIMIT"]) or 10
+    todos = count_todos()
+
+    def todo_texts(numbers):
+        for task in read_tasks(numbers):
+            yield (task.number, task.text)
+
+    (entries, done_grams) = done_search_index()
+
+    def done_texts(ids):
+        for i in sorted(ids):
+            (path, offset) = entries[i]
+            with open(path, "rb") as fd:
+                fd.seek(offset)
+                yield (i, fd.readline().decode(ENCODING))
+
+    found = _ranked(grams, search_index(), limit, todo_texts)
+    found.extend([(score, todos + i + 1, text) for (score, i, text) in
+        _ranked(grams, done_grams, limit, done_texts)])
+    found.sort(key=lambda s: (-s[0], s[1]))
+    found = [Task(n, text.rstrip("\n")) for (_, n, text) in found[:limit]]
+    pad = _padding(todos + len(entries))
+    write_lines(line for (_, _, line) in _format_tasks(found, pad))
+    print_x_of_y(found, todos + len(entries))
+### End Search Functions
+
+
+### Aggregate Functions
+# ls --dirs lists several TODO_DIRs as one: a pool of worker processes each
+# loads and filters one directory's todo.txt at a time and returns its
+# matching items sorted, and those are merged into a single listing.
+
+# Settings for files of the listing directory, which the workers mustn't
+# use for the directories they list.
+_DIR_FILES = ("TMP_FILE", "REPORT_FILE", "INDEX_FILE", "CACHE_FILE",
+        "TAG_INDEX", "LOCK_FILE", "JOURNAL_FILE", "DATE_INDEX", "SEARCH_INDEX",
+        "DONE_DIR")
+_glob_re = re.compile('[*?[]')
+
+
+def _todo_dirs(spec):
+    """The directories in spec, a comma separated list of paths and glob
+    patterns, in order and without repeats."""
+    dirs = []
+    for part in spec.split(","):
+        part = part.strip()
+        if _glob_re.search(part):
+            dirs.extend([d for d in sorted(glob.glob(os.path.expanduser(part)))
+                if os.path.isdir(d)])
+        elif part:
+            dirs.append(part)
+    seen = set()
+    unique = []
+    for d in map(os.path.normpath, dirs):
+        if d not in seen:
+            seen.add(d)
+            unique.append(d)
+    return unique
+
+
+@locked(False)
+def _dir_listing(terms, size):
+    """Return ([(sort key, number, record)], count of items) for the items of
+    todo.txt matching the query terms, sorted as ls lists them. Only the
+    first size are returned unless size is 0."""
+    match, _ = compile_query(terms)
+    key = _sort_key() or (lambda task: _PRIORITY_RANK[_category(task)])
+    count = 0
+    items = []
+    for task in iter_tasks():
+        count += 1
+        if match is None or match(task):
+            items.append((key(task), task.number, task.record()))
+    if size:
+        return (heapq.nsmallest(size, items), count)
+    items.sort()
+    return (items, count)
+
+
+def _dir_tasks(job):
+    """Run _dir_listing() on one directory in a worker process. job is
+    (directory, query terms, configuration, size); the directory's own
+    config file is read if it has one. Returns (items, count, error), where
+    error says why the directory was skipped, or is None."""
+    directory, terms, config, size = job
+    CONFIG.clear()
+    CONFIG.update(config)
+    # A forked worker doesn't hold its parent's lock.
+    _lock.update({"fd": None, "exclusive": False, "depth": 0})
+    path = _path(directory)
+    config_file = _pathc([path, "/config"])
+    perms = os.F_OK | os.R_OK | os.W_OK
+    if os.access(path, perms | os.X_OK) and os.access(config_file, perms):
+        get_config(dir_name=path)
+    else:
+        CONFIG["TODO_DIR"] = path
+        CONFIG["TODO_FILE"] = _pathc([path, "/todo.txt"])
+        CONFIG["DONE_FILE"] = _pathc([path, "/done.txt"])
+    if not os.path.isfile(CONFIG["TODO_FILE"]):
+        # Checked first so no lock file is left in a directory without one.
+        return ([], 0, "no todo.txt")
+    try:
+        return _dir_listing(terms, size) + (None,)
+    except (IOError, OSError, LockTimeout) as e:
+        return ([], 0, str(e))
+
+
+def list_dirs(terms):
+    """ls with --dirs: list the items matching the query terms in each of the
+    TODO_DIRS as one listing, in the order ls lists them. Each line starts
+    with the directory it's from, so that todo.py -d DIR can change it.
+    Directories that can't be listed are reported and skipped."""
+    try:
+        compile_query(terms)
+        _sort_key()
+    except ValueError as e:
+        print(concat(["TODO: ", str(e)]))
+        return
+    dirs = _todo_dirs(CONFIG["TODO_DIRS"])
+    limit, offset = int(CONFIG["LIMIT"]), int(CONFIG["OFFSET"])
+    size = offset + limit if limit > 0 else 0
+
+    config = dict([(k, v) for (k, v) in CONFIG.items() if k != "GIT"])
+    config.update([(k, "") for k in _DIR_FILES])
+    config["USE_GIT"] = False
+    jobs = [(d, list(terms), config, size) for d in dirs]
+    results = []
+    if jobs:
+        processes = min(len(jobs), cpu_count())
+        pool = Pool(processes)
+        try:
+            results = pool.map(_dir_tasks, jobs,
+                    max(1, len(jobs) // (processes * 4)))
+        finally:
+            pool.close()
+            pool.join()
+
+    total = sum([count for (_, count, _) in results])
+    pad = _padding(max([count for (_, count, _) in results] or [0]))
+    merged = heapq.merge(*[[(key, i, number, record)
+        for (key, number, record) in items]
+        for (i, (items, _, _)) in enumerate(results)])
+    picked = list(islice(merged, offset, size or None))
+    tasks = (Task.from_record(number, record)
+            for (_, _, number, record) in picked)
+    shown = write_lines(concat([dirs[item[1]], ":", line])
+            for (item, (_, _, line)) in zip(picked, _format_tasks(tasks, pad)))
+    for (directory, (_, _, error)) in zip(dirs, results):
+        if error:
+            print("TODO: Skipped {0}: {1}".format(directory, error))
+    print_x_of_y(shown, total)
+### End Aggregate Functions
+
+
 ### Callback functions for options
 def version(option, opt, value, parser):
     print("""TODO.TXT Command Line Interface v{version}-{id}
@@ -945,18 +3131,30 @@ def toggle_opt(option, opt_str, val, parser):
     """
     Check opt_str to see if it's one of ['-+', '-@', '-#', '-p', '-P', '-t',
     '--plain-mode', '--no-priority', '--prepend-date', '-i',
-    '--invert-colors'] and toggle that option in CONFIG.
+    '--invert-colors', '-l', '--legacy', '--overdue', '--pager'] and toggle
+    that option in CONFIG.
     """
     toggle_dict = {"-+": "HIDE_PROJ", "-@": "HIDE_CONT", "-#": "HIDE_DATE",
             "-p": "PLAIN", "-P": "NO_PRI", "-t": "PRE_DATE",
             "--plain-mode": "PLAIN", "--no-priority": "NO_PRI",
             "--prepend-date": "PRE_DATE", "-i": "INVERT",
             "--invert-colors": "INVERT", "-l": "LEGACY",
-            "--legacy": "LEGACY",
+            "--legacy": "LEGACY", "--overdue": "OVERDUE",
+            "--pager": "USE_PAGER",
             }
     if opt_str in list(toggle_dict.keys()):
         k = toggle_dict[opt_str]
         CONFIG[k] ^= True
+
+
+def set_opt(option, opt_str, val, parser):
+    """Store the value given to one of ['--from', '--to', '--max-lines',
+    '--limit', '--offset', '--sort', '--dirs'] in CONFIG."""
+    set_dict = {"--from": "DATE_FROM", "--to": "DATE_TO",
+            "--max-lines": "MAX_LINES", "--limit": "LIMIT",
+            "--offset": "OFFSET", "--sort": "SORT", "--dirs": "TODO_DIRS"}
+    if opt_str in set_dict:
+        CONFIG[set_dict[opt_str]] = val
 ### End callback functions
 
 
@@ -1000,6 +3198,51 @@ def opt_setup():
             callback=toggle_opt,
             help="Toggle organization of items in the old manner."
             )
+    opts.add_option("--pager", action="callback", callback=toggle_opt,
+            help="Toggle sending listings to $PAGER on a terminal."
+            )
+    opts.add_option("--overdue", action="callback", callback=toggle_opt,
+            help="Only list the undone items dated before today with lsd."
+            )
+    opts.add_option("--from", action="callback", callback=set_opt,
+            type="string", nargs=1,
+            help=concat(["Only include done items completed, or with lsd",
+                "items dated, on or after this date."], " ")
+            )
+    opts.add_option("--to", action="callback", callback=set_opt,
+            type="string", nargs=1,
+            help=concat(["Only include done items completed, or with lsd",
+                "items dated, on or before this date."], " ")
+            )
+    opts.add_option("--max-lines", action="callback", callback=set_opt,
+            type="int", nargs=1,
+            help=concat(["Keep at most this many items in memory while",
+                "listing, sorting the rest on disk."], " ")
+            )
+    opts.add_option("--limit", action="callback", callback=set_opt,
+            type="int", nargs=1,
+            help="Only list this many items, the most important first."
+            )
+    opts.add_option("--offset", action="callback", callback=set_opt,
+            type="int", nargs=1,
+            help=concat(["Skip this many of the most important items when ",
+                "listing, with or without --limit."])
+            )
+    opts.add_option("--sort", action="callback", callback=set_opt,
+            type="string", nargs=1,
+            help=concat(["Order listed items by these comma separated keys:",
+                "pri, created, due, project, context, text, num."], " ")
+            )
+    opts.add_option("--dirs", action="callback", callback=set_opt,
+            type="string", nargs=1,
+            help=concat(["List the items of each of these comma separated",
+                "directories (or glob patterns) together with ls."], " ")
+            )
+    opts.add_option("--format", dest="format", default="",
+            type="string", nargs=1,
+            help=concat(["Template for listed items, e.g.",
+                "\"{num} {pri} {text}\"; see TODOTXT_FORMAT."], " ")
+            )
     opts.add_option("-+", action="callback", callback=toggle_opt,
             help="Toggle display of +projects in-line with items."
             )
@@ -1009,16 +3252,24 @@ def opt_setup():
     opts.add_option("-#", action="callback", callback=toggle_opt,
             help="Toggle display of #{dates} in-line with items."
             )
+    # Everything after the action is its arguments, so a query's -TERM
+    # isn't taken for an option.
+    opts.disable_interspersed_args()
     return opts
 
 
-if __name__ == "__main__":
-    CONFIG["TODO_PY"] = sys.argv[0]
-    opts = opt_setup()
-
-    valid, args = opts.parse_args()
+def run(valid, args):
+    """Run the command in args with the options in valid, as returned by
+    opt_setup().parse_args(), once the configuration is read."""
+    if valid.format:
+        CONFIG["TODOTXT_FORMAT"] = valid.format
 
-    get_config(valid.config, valid.todo_dir)
+    try:
+        _compile_format()
+        _sort_key()
+    except ValueError as e:
+        print(concat(["TODO: ", str(e)]))
+        sys.exit(1)
 
     global commands
     commands = {
@@ -1041,12 +3292,20 @@ if __name__ == "__main__":
             "list"		: (True, list_todo),
             "listall"	: (False, list_all),
             "lsa"		: (False, list_all),
-            "lsc"		: (False, list_context),
-            "listcon"	: (False, list_context),
+            "lsc"		: (True, list_context),
+            "listcon"	: (True, list_context),
             "lsd"		: (False, list_date),
             "listdate"	: (False, list_date),
-            "lsp"		: (False, list_project),
-            "listproj"	: (False, list_project),
+            "next"		: (True, next_todo),
+            "search"	: (True, search_todo),
+            "compact"	: (False, compact),
+            "serve"		: (False, serve),
+            "api"		: (True, api),
+            "lsb"		: (True, list_by),
+            "listby"	: (True, list_by),
+            "lsp"		: (True, list_project),
+            "listproj"	: (True, list_project),
+            "archive"	: (True, archive),
             "h"			: (False, cmd_help),
             "help"		: (False, cmd_help),
             }
@@ -1064,24 +3323,696 @@ if __name__ == "__main__":
         args.append(CONFIG["TODOTXT_DEFAULT_ACTION"])
 
     all_re = re.compile('((app|pre)(?:end)?|p(?:ri)?)')
-    all_set = set(["ls", "list", "a", "add", "addm"])
-
-    while args:
-        # ensure this doesn't error because of a faulty CAPS LOCK key
-        arg = args.pop(0).lower()
-        if arg in commandsl:
-            if not commands[arg][0]:
-                commands[arg][1]()
-            else:
-                if all_re.match(arg) or arg in all_set:
-                    commands[arg][1](args)
-                    args = None
+    all_set = set(["ls", "list", "a", "add", "addm", "do", "del", "rm", "dp",
+        "depri", "archive", "lsp", "listproj", "lsc", "listcon",
+        "lsb", "listby", "next", "search", "api"])
+
+    # The listing commands; their output goes through $PAGER with USE_PAGER.
+    paged_set = set(["ls", "list", "lsa", "listall", "lsc", "listcon", "lsd",
+        "listdate", "lsp", "listproj", "lsb", "listby", "next", "search"])
+
+    try:
+        with paged(args[0].lower() in paged_set):
+            while args:
+                # ensure this doesn't error because of a faulty CAPS LOCK key
+                arg = args.pop(0).lower()
+                if arg in commandsl:
+                    if not commands[arg][0]:
+                        commands[arg][1]()
+                    else:
+                        if all_re.match(arg) or arg in all_set:
+                            commands[arg][1](args)
+                            args = None
+                        else:
+                            commands[arg][1](args.pop(0))
                 else:
-                    commands[arg][1](args.pop(0))
+                    commandsl.sort()
+                    commandsl = ["\t" + i for i in commandsl]
+                    print("Unable to find command: {0}".format(arg))
+                    print("Valid commands: ")
+                    print(concat(commandsl, "\n"))
+                    sys.exit(1)
+    except LockTimeout as e:
+        print(concat(["TODO: ", e]))
+        sys.exit(1)
+    except (IOError, OSError) as e:
+        # The reader went away, e.g. todo.py ls | head, which is no error.
+        if e.errno != errno.EPIPE:
+            raise
+        _quiet_stdout()
+        sys.exit(0)
+
+
+def main(argv):
+    """The todo.py command line: argv is sys.argv."""
+    CONFIG["TODO_PY"] = argv[0]
+    opts = opt_setup()
+
+    valid, args = opts.parse_args(argv[1:])
+
+    get_config(valid.config, valid.todo_dir)
+    run(valid, args)
+### End Main components
+
+
+### Server Functions
+# todo.py serve keeps the configuration, the parsed list and the indexes in
+# memory and runs the commands sent to its socket. Every other todo.py first
+# tries to forward its arguments there and runs them itself if no server
+# answers. Both find the socket the same way: $TODOTXT_SOCKET, or todo.sock
+# in the TODO_DIR (given with -d, or ~/.todo).
+#
+# A request is the marshal'd (directory, argv), directory being the TODO_DIR
+# the client means (see _forward_dir()). The reply is a series of frames,
+# each an _FRAME header (kind, length): output frames carry length bytes of
+# UTF-8 text as the command writes it, and the last frame holds the exit
+# status in its length. A server for another directory, as can happen with
+# $TODOTXT_SOCKET, only sends a refused frame, and the client runs argv
+# itself.
+_FRAME = struct.Struct("<BI")
+_FRAME_OUTPUT, _FRAME_STATUS, _FRAME_REFUSED = 0, 1, 2
+# How much output is gathered before it's sent to the client.
+_FRAME_SIZE = 4096
+_dir_opt_re = re.compile('^(?:-d(.+)|--dir=(.*))$')
+
+
+def _socket_path(todo_dir=None):
+    """The socket of the server for todo_dir (by default TODO_DIR)."""
+    if os.environ.get("TODOTXT_SOCKET"):
+        return _path(os.environ["TODOTXT_SOCKET"])
+    return _pathc([_path(todo_dir or CONFIG["TODO_DIR"]), "/todo.sock"])
+
+
+def _forward_dir(argv):
+    """The directory given to -d or --dir in argv, or ~/.todo."""
+    args = argv[1:]
+    for (i, arg) in enumerate(args):
+        m = _dir_opt_re.match(arg)
+        if m:
+            return m.group(1) or m.group(2)
+        if arg in ("-d", "--dir") and i + 1 < len(args):
+            return args[i + 1]
+    return "~/.todo"
+
+
+def _recv_all(conn):
+    """Read from conn until the other end is done writing."""
+    chunks = []
+    while True:
+        chunk = conn.recv(1 << 16)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def _recv_exactly(conn, size):
+    """Read size bytes from conn. Raises EOFError if it closes first."""
+    chunks = []
+    while size > 0:
+        chunk = conn.recv(min(size, 1 << 16))
+        if not chunk:
+            raise EOFError("the server went away")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def forward(argv):
+    """Run argv on a running server, writing its output to stdout as it
+    arrives, and exit with its status. Returns False if there is no server
+    to run it, the server is for another directory than argv's, or argv
+    picks its own configuration file with -c or starts a server itself."""
+    if not hasattr(socket, "AF_UNIX") or (set(argv[1:]) &
+            set(["-c", "--config", "serve", "api"])) or [a for a in argv[1:]
+                if a.startswith("--config=")]:
+        return False
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(_socket_path(_forward_dir(argv)))
+    except socket.error:
+        conn.close()
+        return False
+
+    status = 1
+    try:
+        directory = os.path.realpath(_path(_forward_dir(argv)))
+        conn.sendall(marshal.dumps((directory, list(argv))))
+        conn.shutdown(socket.SHUT_WR)
+        while True:
+            kind, size = _FRAME.unpack(_recv_exactly(conn, _FRAME.size))
+            if kind == _FRAME_REFUSED:
+                return False
+            if kind == _FRAME_STATUS:
+                status = size
+                break
+            text = _recv_exactly(conn, size)
+            if str is not bytes:
+                text = text.decode("utf-8")
+            sys.stdout.write(text)
+            sys.stdout.flush()
+    except (socket.error, IOError, OSError, EOFError) as e:
+        if getattr(e, "errno", None) == errno.EPIPE:
+            _quiet_stdout()  # e.g. todo.py ls | head
+            status = 0
+        else:
+            sys.stderr.write(concat(["TODO: ", e, "\n"]))
+    finally:
+        conn.close()
+    sys.exit(status)
+
+
+class _ServerOutput(object):
+    """The stdout of a command run by serve(): what it writes is sent to the
+    client in output frames of about _FRAME_SIZE, so long listings start
+    showing up right away. Once the client has gone away writes fail with
+    EPIPE, as they would on a closed pipe."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.chunks = []
+        self.size = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= _FRAME_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.chunks:
+            return
+        data = "".join(self.chunks)
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self.chunks = []
+        self.size = 0
+        self.send(_FRAME_OUTPUT, len(data), data)
+
+    def send(self, kind, size, data=b""):
+        try:
+            self.conn.sendall(_FRAME.pack(kind, size) + data)
+        except socket.error:
+            raise IOError(errno.EPIPE, "the client went away")
+
+    def isatty(self):
+        return False
+
+
+def _run_to(stdout, func, *args):
+    """Call func(*args) with stdout as sys.stdout and an empty stdin, as a
+    server must: the commands print, and nobody is there to answer a
+    prompt(). Returns (exit status, return value); an exception is written
+    to stdout."""
+    saved = (sys.stdin, sys.stdout)
+    sys.stdin = StringIO()
+    sys.stdout = stdout
+    status = 0
+    result = None
+    try:
+        result = func(*args)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
         else:
-            commandsl.sort()
-            commandsl = ["\t" + i for i in commandsl]
-            print("Unable to find command: {0}".format(arg))
-            print("Valid commands: ")
-            print(concat(commandsl, "\n"))
+            print(e.code)
+            status = 1
+    except EOFError:
+        print(concat(["\nTODO: Can't ask for input through a server; give ",
+            "the arguments on the command line."]))
+        status = 1
+    except Exception:
+        traceback.print_exc(file=stdout)
+        status = 1
+    finally:
+        sys.stdin, sys.stdout = saved
+    return (status, result)
+
+
+def _captured(func, *args):
+    """_run_to() with the output captured. Returns (exit status, output,
+    return value)."""
+    output = StringIO()
+    status, result = _run_to(output, func, *args)
+    return (status, output.getvalue(), result)
+
+
+def _serves(directory, baseline):
+    """Return True if a server started with the configuration baseline is
+    the one for the TODO_DIR directory: its TODO_DIR, or the directory of
+    its config file."""
+    served = [baseline["TODO_DIR"],
+            os.path.dirname(_path(baseline["TODOTXT_CFG_FILE"]))]
+    return directory in [os.path.realpath(_path(d)) for d in served if d]
+
+
+def _serve_request(argv, baseline, stdout):
+    """Run argv as main() would, on a fresh copy of the configuration the
+    server started with, writing its output to stdout. Returns the exit
+    status."""
+    CONFIG.clear()
+    CONFIG.update(baseline)
+    CONFIG["TODO_PY"] = argv[0]
+    return _run_to(stdout, lambda: run(*opt_setup().parse_args(argv[1:])))[0]
+
+
+@usage('\tserve',
+    '\t\tKeeps todo.py running, answering the commands of other todo.py',
+    '\t\tcalls over the socket $TODOTXT_SOCKET, or todo.sock in TODO_DIR.\n')
+def serve():
+    """Answer requests sent by forward() until interrupted."""
+    global _resident
+    path = _socket_path()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        try:
+            listener.connect(path)
+        except socket.error:
+            os.unlink(path)  # left behind by a server that's gone
+        else:
+            print("TODO: A server is already running on {0}.".format(path))
             sys.exit(1)
+        listener.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(64)
+    print("TODO: Serving on {0}.".format(path))
+    sys.stdout.flush()
+
+    _resident = {}
+    baseline = dict(CONFIG)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            try:
+                directory, argv = marshal.loads(_recv_all(conn))
+                output = _ServerOutput(conn)
+                if not _serves(directory, baseline):
+                    output.send(_FRAME_REFUSED, 0)
+                    continue
+                status = _serve_request(argv, baseline, output)
+                output.flush()
+                output.send(_FRAME_STATUS, status)
+            except (socket.error, IOError, EOFError, ValueError, TypeError):
+                pass  # the client went away or sent garbage
+            finally:
+                conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        os.unlink(path)
+        _resident = None
+    sys.exit(0)
+### End Server Functions
+
+
+### API Functions
+# todo.py api serves the list as JSON over HTTP/1.1 on ADDRESS: HOST:PORT, a
+# PORT on localhost or the path of a Unix socket.
+#
+#   GET    /todos?q=QUERY      the items matching QUERY (see compile_query()),
+#                              in listing order; each q= is one term
+#   POST   /todos              add {"text": "..."}
+#   POST   /todos/ITEMS/do     mark ITEMS as done
+#   POST   /todos/ITEMS/pri    prioritize ITEMS with {"pri": "A"}, or remove
+#                              their priority with {"pri": null}
+#   DELETE /todos/ITEMS        delete ITEMS
+#
+# ITEMS is one or more comma separated NUMBERs, FIRST-LAST ranges, +projects
+# or @contexts, as do, pri and del take them. A change is answered with its
+# exit status and the lines the command printed.
+#
+# Everything runs on one asyncio event loop, which never blocks on the lock
+# on todo.txt: see _api_locked(). Reads are answered as soon as they have
+# the shared lock, from the parsed list kept in memory as serve() keeps it.
+# Changes are queued for a single writer, which runs all of those waiting
+# under one exclusive lock and one sync_batch() before answering them. A
+# change to items that don't exist is answered with a 404.
+_API_REASONS = {200: "OK", 201: "Created", 400: "Bad Request",
+        404: "Not Found", 405: "Method Not Allowed", 409: "Conflict"}
+_API_MAX_HEAD = 1 << 16
+_API_MAX_BODY = 1 << 20
+_api_path_re = re.compile('^/todos(?:/([^/]+)(?:/(do|pri))?)?/?$')
+# The method of each change: by whether ITEMS is given, and the action.
+_API_METHODS = {(False, None): "POST", (True, None): "DELETE",
+        (True, "do"): "POST", (True, "pri"): "POST"}
+
+
+def _http_request(data):
+    """Parse the HTTP/1.x request at the start of data. Returns None until
+    all of it has arrived, then (method, target, keep alive, body, rest of
+    data). Raises ValueError for a malformed request."""
+    end = data.find(b"\r\n\r\n")
+    if end < 0:
+        if len(data) > _API_MAX_HEAD:
+            raise ValueError("the request head is too long")
+        return None
+    lines = data[:end].decode("latin-1").split("\r\n")
+    request = lines[0].split()
+    if len(request) != 3 or not request[2].startswith("HTTP/1."):
+        raise ValueError("malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise ValueError("malformed header")
+        headers[name.strip().lower()] = value.strip()
+    if "transfer-encoding" in headers:
+        raise ValueError("chunked bodies aren't supported")
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise ValueError("malformed Content-Length")
+    if not 0 <= length <= _API_MAX_BODY:
+        raise ValueError("the body is too long")
+    start = end + 4
+    if len(data) < start + length:
+        return None
+    connection = headers.get("connection", "").lower()
+    if request[2] == "HTTP/1.0":
+        keep = connection == "keep-alive"
+    else:
+        keep = connection != "close"
+    return (request[0].upper(), request[1], keep,
+            data[start:start + length], data[start + length:])
+
+
+def _task_json(task):
+    """The parsed fields of task as a dict for json.dumps()."""
+    return {"num": task.number, "text": task.text, "pri": task.priority,
+            "done": task.done, "created": task.created,
+            "projects": task.projects, "contexts": task.contexts,
+            "dates": [d.isoformat() for d in task.dates]}
+
+
+@locked(False)
+def api_list(match, tags):
+    """The reply to GET /todos: the items for which match(task) holds, or
+    all of them if match is None, in listing order. As in ls, with
+    TAG_INDEX only the lines having the tags of the query are read."""
+    key = _sort_key() or (lambda task: _PRIORITY_RANK[_category(task)])
+    tasks = iter_tasks()
+    total = None
+    index = tag_index() if tags else None
+    if index is not None:
+        numbers = tagged_lines(index, tags[0])
+        for tag in tags[1:]:
+            numbers.intersection_update(tagged_lines(index, tag))
+        tasks = read_tasks(numbers)
+        total = count_todos()
+
+    count = 0
+    matching = []
+    for task in tasks:
+        count += 1
+        if match is None or match(task):
+            matching.append(task)
+    matching.sort(key=key)  # stable, so ties keep their todo.txt order
+    return {"todos": [_task_json(t) for t in matching],
+            "total": count if total is None else total}
+
+
+def _api_selectors(items):
+    """Split the ITEMS of a request path into selectors for select_todos(),
+    or return None if one of them isn't valid."""
+    selectors = [s for s in items.split(",") if s]
+    for sel in selectors:
+        if not (_selector_re.match(sel) or
+                (sel[:1] in ("+", "@") and sel[1:])):
+            return None
+    return selectors or None
+
+
+def _api_request(method, target, body):
+    """Route one request. Returns (code, reply) for an error, else (None,
+    job): ("read", match, tags) for a listing, or ("change", command,
+    selectors, args) for a change the writer has to run."""
+    url = urlsplit(target)
+    m = _api_path_re.match(unquote(url.path))
+    if not m:
+        return (404, {"error": "no such resource"})
+    items, action = m.groups()
+    if items is None and method == "GET":
+        try:
+            match, tags = compile_query(parse_qs(url.query).get("q", []))
+        except ValueError as e:
+            return (400, {"error": str(e)})
+        return (None, ("read", match, tags))
+
+    if _API_METHODS[(items is not None, action)] != method:
+        return (405, {"error": "method not allowed"})
+    try:
+        fields = json.loads(body.decode("utf-8")) if body else {}
+    except ValueError:
+        return (400, {"error": "the body isn't valid JSON"})
+    if not isinstance(fields, dict):
+        return (400, {"error": "the body must be a JSON object"})
+
+    if items is None:
+        text = fields.get("text")
+        if not isinstance(text, text_type) or not text.strip() or \
+                "\n" in text or "\r" in text:
+            return (400, {"error": "text must be a single line"})
+        return (None, ("change", add_todo, None, text))
+    selectors = _api_selectors(items)
+    if selectors is None:
+        return (400, {"error": concat(["invalid items: ", items])})
+    if action == "do":
+        return (None, ("change", do_todo, selectors, []))
+    if action is None:
+        return (None, ("change", delete_todo, selectors, []))
+    pri = fields.get("pri")
+    if pri is None:
+        return (None, ("change", de_prioritize_todo, selectors, []))
+    if not isinstance(pri, text_type) or len(pri) != 1 or \
+            pri.upper() not in PRIORITIES:
+        return (400, {"error": "pri must be a letter in [A-X] or null"})
+    return (None, ("change", prioritize_todo, selectors, [str(pri)]))
+
+
+def _api_read(match, tags):
+    """Answer a listing: (code, reply)."""
+    status, output, reply = _captured(api_list, match, tags)
+    if status:
+        return (409, {"error": output.strip()})
+    return (200, reply)
+
+
+def _api_change(command, selectors, args):
+    """Run one change, command(selectors + args), or command(args) for an
+    add. Returns (code, reply). If the items don't exist nothing is changed
+    and the reply is a 404."""
+    if selectors is not None:
+        status, output, selected = _captured(select_todos, selectors)
+        if status or output or not selected:
+            return (409 if status else 404,
+                    {"error": output.strip() or "No such todo."})
+        args = selectors + args
+    status, output, value = _captured(command, args)
+    reply = {"status": status, "output": output.splitlines()}
+    if status:
+        return (409, reply)
+    if command is add_todo:
+        reply["num"] = value
+        return (201, reply)
+    return (200, reply)
+
+
+def _api_locked(loop, exclusive, func, deadline=None):
+    """Call func(None) holding the lock on todo.txt, as locked() would. The
+    event loop isn't blocked while another process holds the lock: the
+    attempt is retried by a timer until LOCK_TIMEOUT, after which
+    func(error) is called without the lock."""
+    if fcntl is None:
+        func(None)
+        return
+    if deadline is None:
+        deadline = time() + float(CONFIG["LOCK_TIMEOUT"])
+    fd = _open_lock(exclusive)
+    if fd is None:
+        func(None)
+        return
+    if not _try_lock(fd, exclusive):
+        fd.close()
+        if time() >= deadline:
+            func(str(LockTimeout(CONFIG["LOCK_TIMEOUT"])))
+        else:
+            loop.call_later(0.05, _api_locked, loop, exclusive, func,
+                    deadline)
+        return
+    _lock.update({"fd": fd, "exclusive": exclusive, "depth": 1})
+    try:
+        func(None)
+    finally:
+        _lock.update({"fd": None, "exclusive": False, "depth": 0})
+        fd.close()  # which releases the lock
+
+
+class _ApiWriter(object):
+    """The single writer of api(). Changes are queued as they arrive, and
+    once the exclusive lock is had all of those waiting are run under it in
+    one sync_batch(), so a batch costs one wait for the lock and one pass of
+    fsyncs. Each is answered after the batch."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = []
+        self.scheduled = False
+
+    def submit(self, job, done):
+        """Queue job, a (command, selectors, args) tuple; done() is called
+        with its (code, reply) once it has run."""
+        self.queue.append((job, done))
+        if not self.scheduled:
+            self.scheduled = True
+            self.loop.call_soon(_api_locked, self.loop, True, self.run)
+
+    def run(self, error):
+        self.scheduled = False
+        batch, self.queue = self.queue, []
+        if error:
+            results = [(409, {"error": error})] * len(batch)
+        else:
+            with sync_batch():
+                results = [_api_change(*job) for (job, _) in batch]
+        for ((_, done), result) in zip(batch, results):
+            done(result)
+
+
+class _ApiConnection(asyncio.Protocol if asyncio else object):
+    """One connection to api(). Its requests are answered in order: nothing
+    more is read from it while one waits for the lock or the writer."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.transport = None
+        self.buffer = b""
+        self.waiting = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def data_received(self, data):
+        self.buffer += data
+        self.handle()
+
+    def handle(self):
+        """Answer the complete requests in the buffer."""
+        while self.transport is not None and not self.waiting:
+            try:
+                request = _http_request(self.buffer)
+            except ValueError as e:
+                self.reply(400, {"error": str(e)}, True)
+                return
+            if request is None:
+                return
+            method, target, keep, body, self.buffer = request
+            code, reply = _api_request(method, target, body)
+            if code is not None:
+                self.reply(code, reply, not keep)
+                continue
+            self.waiting = True
+            self.transport.pause_reading()
+            done = partial(self.answer, keep)
+            if reply[0] == "read":
+                _api_locked(self.writer.loop, False, partial(self.read, done,
+                    reply[1], reply[2]))
+            else:
+                self.writer.submit(reply[1:], done)
+
+    def read(self, done, match, tags, error):
+        if error:
+            done((409, {"error": error}))
+        else:
+            done(_api_read(match, tags))
+
+    def answer(self, keep, result):
+        """Send the (code, reply) of a request that had to wait."""
+        self.waiting = False
+        if self.transport is None:
+            return
+        self.transport.resume_reading()
+        self.reply(result[0], result[1], not keep)
+        self.handle()
+
+    def reply(self, code, data, close):
+        body = json.dumps(data).encode("utf-8")
+        head = concat(["HTTP/1.1 {0} {1}\r\n".format(code, _API_REASONS[code]),
+            "Content-Type: application/json\r\n",
+            "Content-Length: {0}\r\n".format(len(body)),
+            "Connection: close\r\n" if close else "", "\r\n"])
+        self.transport.write(head.encode("latin-1") + body)
+        if close:
+            self.transport.close()
+            self.transport = None
+
+
+def _loopback(host):
+    """True if every address host resolves to is a loopback address."""
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(host, None)]
+    except socket.error:
+        return False
+    for address in addresses:
+        if not (address.startswith("127.") or address == "::1"):
+            return False
+    return bool(addresses)
+
+
+@usage('\tapi [ADDRESS]',
+    '\t\tServes todo.txt as JSON over HTTP on ADDRESS: a loopback',
+    '\t\tHOST:PORT, a PORT on localhost or the path of a Unix socket (by',
+    '\t\tdefault API_ADDRESS, or localhost:8080). GET /todos?q=QUERY lists',
+    '\t\titems, POST /todos adds {"text": "..."}, POST /todos/ITEMS/do',
+    '\t\tmarks items as done, POST /todos/ITEMS/pri sets {"pri": "A"} and',
+    '\t\tDELETE /todos/ITEMS deletes items.\n')
+def api(args):
+    """Serve the JSON API until interrupted."""
+    global _resident
+    if asyncio is None:
+        print("TODO: api needs Python 3.4 or later.")
+        sys.exit(1)
+    address = (args[0] if args else CONFIG["API_ADDRESS"]) or "localhost:8080"
+    loop = asyncio.new_event_loop()
+    writer = _ApiWriter(loop)
+    factory = lambda: _ApiConnection(writer)
+    try:
+        if "/" in address:
+            address = _path(address)
+            server = loop.create_unix_server(factory, address)
+        else:
+            host, _, port = address.rpartition(":")
+            host = host.strip("[]") or "localhost"
+            if not _loopback(host):
+                raise ValueError("only localhost and Unix sockets are served")
+            server = loop.create_server(factory, host, int(port))
+        server = loop.run_until_complete(server)
+    except (OSError, ValueError) as e:
+        loop.close()
+        print(concat(["TODO: Can't serve on ", address, ": ", e]))
+        sys.exit(1)
+    print("TODO: Serving the API on {0}.".format(address))
+    sys.stdout.flush()
+
+    _resident = {}
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        _resident = None
+        if "/" in address and os.path.exists(address):
+            os.unlink(address)
+    sys.exit(0)
+### End API Functions
+
+
+if __name__ == "__main__":
+    if not forward(sys.argv):
+        main(sys.argv)